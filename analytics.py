@@ -0,0 +1,262 @@
+import array
+import asyncio
+import collections
+import datetime
+import metrics
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A copy of the badges table kept in memory one column per field, for dashboards and reports. Strings are
+# stored as small integer codes and dates as plain numbers in array.array columns, so grouping and counting is
+# integer arithmetic over a few contiguous buffers (vectorized with NumPy when it's installed) and answering
+# never waits on SQLite, the write lock or a sync.
+#
+# It follows the cache's listener: rows that changed are read back and patched in place, and a reload reads
+# the whole table into fresh columns that are swapped in once they're complete.
+
+ANALYTICS_ROWS = metrics.gauge('analytics_snapshot_rows', 'Registrants in the in-memory analytics snapshot.')
+ANALYTICS_REFRESH_SECONDS = metrics.histogram('analytics_refresh_seconds', 'Time to bring the analytics snapshot up to date.', ('kind',))
+
+CATEGORY_COLUMNS = ('badgeLevel', 'status', 'billingCountry')
+GROUPS = CATEGORY_COLUMNS + ('ageAtEvent', 'checkInHour')
+
+class _Codes:
+    # Each distinct string gets the next integer. Codes are never reused, so they stay valid for the life of the columns.
+    def __init__(self):
+        self.names = []
+        self._codes = {}
+
+    def code(self, name):
+        code = self._codes.get(name)
+        if code is None:
+            code = self._codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def find(self, name):
+        return self._codes.get(name, -1)
+
+class _Columns:
+    def __init__(self):
+        self.index = {}
+        self.registrant_id = array.array('q')
+        self.codes = {column: _Codes() for column in CATEGORY_COLUMNS}
+        self.category = {column: array.array('i') for column in CATEGORY_COLUMNS}
+        # Birthdays split up so ages can be worked out without making date objects. 0 when unknown.
+        self.birth_year = array.array('i')
+        self.birth_month_day = array.array('i')
+        self.checked_in = array.array('b')
+        # Seconds since the epoch, 0 when not checked in.
+        self.date_checked_in = array.array('q')
+
+    def __len__(self):
+        return len(self.registrant_id)
+
+    def _all(self):
+        return [self.registrant_id, self.birth_year, self.birth_month_day, self.checked_in, self.date_checked_in] + list(self.category.values())
+
+    def set_row(self, row):
+        position = self.index.get(row['registrantId'])
+        if position is None:
+            position = self.index[row['registrantId']] = len(self.registrant_id)
+            for column in self._all():
+                column.append(0)
+
+        self.registrant_id[position] = row['registrantId']
+        for column in CATEGORY_COLUMNS:
+            self.category[column][position] = self.codes[column].code(row[column])
+        if row['dateOfBirth']:
+            birth = datetime.date.fromordinal(row['dateOfBirth'])
+            self.birth_year[position] = birth.year
+            self.birth_month_day[position] = birth.month * 100 + birth.day
+        else:
+            self.birth_year[position] = 0
+            self.birth_month_day[position] = 0
+        self.checked_in[position] = 1 if row['checkedIn'] else 0
+        self.date_checked_in[position] = row['dateCheckedIn'] or 0
+
+def _view(column):
+    # Shares the array's memory. Don't keep one past the query, since the array can't grow while it exists.
+    return numpy.frombuffer(column, dtype=numpy.dtype(column.typecode))
+
+class RegistrantSnapshot:
+    def __init__(self, cache, start_date):
+        self._cache = cache
+        self._start_date = start_date
+        self._columns = _Columns()
+        self._pending_ids = set()
+        self._pending_reload = False
+        self._refresh_task = None
+        self.updated = None
+        # Goes up every time the snapshot changes.
+        self.generation = 0
+
+    async def start(self):
+        self._cache.add_listener(self._cache_changed)
+        self._pending_reload = True
+        await self._refresh()
+
+    async def close(self):
+        self._cache.remove_listener(self._cache_changed)
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+
+    def __len__(self):
+        return len(self._columns)
+
+    def _cache_changed(self, event, registrant_ids):
+        if event == 'update':
+            self._pending_ids.update(registrant_ids)
+        else:
+            self._pending_reload = True
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+
+    async def _refresh(self):
+        # Whatever changes while the rows are being read is picked up on the next time around.
+        while self._pending_reload or self._pending_ids:
+            start = time.perf_counter()
+            try:
+                if self._pending_reload:
+                    self._pending_reload = False
+                    self._pending_ids.clear()
+                    kind = 'reload'
+                    columns = _Columns()
+                    for row in await self._cache.get_rows():
+                        columns.set_row(row)
+                    self._columns = columns
+                else:
+                    ids, self._pending_ids = self._pending_ids, set()
+                    kind = 'update'
+                    columns = self._columns
+                    for row in await self._cache.get_rows(ids):
+                        columns.set_row(row)
+            except Exception as e:
+                print('Unable to refresh the analytics snapshot: {}'.format(e))
+                return
+            ANALYTICS_REFRESH_SECONDS.observe(time.perf_counter() - start, kind=kind)
+            ANALYTICS_ROWS.set(len(self._columns))
+            self.updated = datetime.datetime.utcnow()
+            self.generation += 1
+
+    @staticmethod
+    def _age_parts(at):
+        if at is None:
+            at = datetime.date.today()
+        return at.year, at.month * 100 + at.day
+
+    def ages(self, at=None):
+        # Age on the date at (the first day of the event by default) for every row, 0 when the birthday is
+        # unknown. Same rules as RegFoxCache.calculate_age.
+        columns = self._columns
+        year, month_day = self._age_parts(at or self._start_date)
+        if numpy is not None:
+            birth_year = _view(columns.birth_year)
+            age = year - birth_year - (_view(columns.birth_month_day) > month_day)
+            age[(birth_year == 0) | (age < 0)] = 0
+            return age
+        return array.array('i', [
+            max(year - birth_year - (birth_month_day > month_day), 0) if birth_year else 0
+            for birth_year, birth_month_day in zip(columns.birth_year, columns.birth_month_day)
+        ])
+
+    def _selected(self, columns, status, checked_in):
+        # The rows to count: a boolean array with NumPy, a list of positions without.
+        status_code = None
+        if status is not None:
+            status_code = columns.codes['status'].find(status)
+        if numpy is not None:
+            selected = numpy.ones(len(columns), dtype=bool)
+            if status_code is not None:
+                selected &= _view(columns.category['status']) == status_code
+            if checked_in is not None:
+                selected &= _view(columns.checked_in) == int(checked_in)
+            return selected
+        return [
+            position for position in range(len(columns))
+            if (status_code is None or columns.category['status'][position] == status_code)
+            and (checked_in is None or columns.checked_in[position] == int(checked_in))
+        ]
+
+    def count_by(self, group, status='completed', checked_in=None):
+        # {value: registrants} for one of GROUPS, among registrants with this status (any status if None) and,
+        # if checked_in isn't None, only those checked in or not. checkInHour is the UTC hour, and only counts
+        # registrants who have checked in.
+        if group not in GROUPS:
+            raise ValueError('group must be one of {} and not {!r}.'.format(', '.join(GROUPS), group))
+        columns = self._columns
+        selected = self._selected(columns, status, checked_in)
+
+        names = None
+        if group in CATEGORY_COLUMNS:
+            keys = columns.category[group]
+            names = columns.codes[group].names
+        elif group == 'ageAtEvent':
+            keys = self.ages()
+        else:
+            keys = None
+
+        if numpy is not None:
+            if keys is None:
+                date_checked_in = _view(columns.date_checked_in)
+                selected &= date_checked_in != 0
+                keys = date_checked_in // 3600 % 24
+            elif not isinstance(keys, numpy.ndarray):
+                keys = _view(keys)
+            counts = numpy.bincount(keys[selected])
+            found = numpy.flatnonzero(counts)
+            return {(names[key] if names is not None else int(key)): int(counts[key]) for key in found}
+
+        if keys is None:
+            counts = collections.Counter(
+                columns.date_checked_in[position] // 3600 % 24
+                for position in selected if columns.date_checked_in[position])
+        else:
+            counts = collections.Counter(keys[position] for position in selected)
+        if names is not None:
+            return {names[key]: count for key, count in counts.items()}
+        return dict(sorted(counts.items()))
+
+    def checkin_rate(self, bucket_seconds=900, status=None):
+        # Check-ins per bucket_seconds, from the bucket with the first check-in to the one with the last, as a
+        # list of (bucket start, check-ins). Empty buckets in between are included.
+        columns = self._columns
+        if numpy is not None:
+            date_checked_in = _view(columns.date_checked_in)
+            selected = date_checked_in != 0
+            if status is not None:
+                selected &= self._selected(columns, status, None)
+            buckets = date_checked_in[selected] // bucket_seconds
+            if not len(buckets):
+                return []
+            first = int(buckets.min())
+            counts = numpy.bincount(buckets - first)
+            return [(datetime.datetime.utcfromtimestamp((first + offset) * bucket_seconds), int(count)) for offset, count in enumerate(counts)]
+
+        positions = range(len(columns)) if status is None else self._selected(columns, status, None)
+        counts = collections.Counter(
+            columns.date_checked_in[position] // bucket_seconds
+            for position in positions if columns.date_checked_in[position])
+        if not counts:
+            return []
+        first = min(counts)
+        return [(datetime.datetime.utcfromtimestamp(bucket * bucket_seconds), counts[bucket]) for bucket in range(first, max(counts) + 1)]
+
+    def summary(self, bucket_seconds=900, status='completed'):
+        checked_in = self.count_by('badgeLevel', status, True)
+        return {
+            'registrants': len(self._columns),
+            'updated': self.updated,
+            'status': status,
+            'checkedIn': sum(checked_in.values()),
+            'byBadgeLevel': self.count_by('badgeLevel', status),
+            'checkedInByBadgeLevel': checked_in,
+            'byCountry': self.count_by('billingCountry', status),
+            'byAgeAtEvent': self.count_by('ageAtEvent', status),
+            'byCheckInHour': self.count_by('checkInHour', status),
+            'checkInRate': [{'start': start, 'checkIns': count} for start, count in self.checkin_rate(bucket_seconds, status)],
+        }
@@ -1,11 +1,16 @@
 from PIL import Image, ImageDraw, ImageFont
 from collections import namedtuple
 from builtins import property
+import functools
 import importlib.util
 import os
 import sys
+import threading
 
 DEFAULT_DPI = 300.0
+FONT_CACHE_SIZE = 64
+POSITION_CACHE_SIZE = 4096
+STATIC_LAYER_CACHE_SIZE = 16
 
 MODE_BW = '1' # Don't use this with truetype fonts.
 MODE_GRAYSCALE = 'L'
@@ -47,9 +52,23 @@ def _descend_into_madness(func, func_name):
 in_to_px = _descend_into_madness(lambda n, dpi: int(n * dpi), 'in_to_px')
 px_to_in = _descend_into_madness(lambda n, dpi: n / dpi, 'px_to_in')
 
+@functools.lru_cache(maxsize=POSITION_CACHE_SIZE)
+def _cached_in_to_px(values, dpi):
+    # Templates draw at the same handful of positions on every badge, so each is only converted once.
+    return in_to_px(*values, dpi=dpi)
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font_file, size_px):
+    # Shared by every template and render. FreeTypeFont objects aren't modified after they're loaded.
+    return ImageFont.truetype(font_file, size_px)
+
 class ImageDrawInches(ImageDraw.ImageDraw):
     def in_to_px(self, *values):
-        return in_to_px(*values, dpi=self._dpi)
+        try:
+            return _cached_in_to_px(values, self._dpi)
+        except TypeError:
+            # Lists can't be cache keys. (Neither can anything else in_to_px rejects, and it'll say so.)
+            return in_to_px(*values, dpi=self._dpi)
 
     def px_to_in(self, *values):
         return px_to_in(*values, dpi=self._dpi)
@@ -99,17 +118,67 @@ class ImageDrawInches(ImageDraw.ImageDraw):
     def dpi(self):
         return self._dpi
 
-    def centertext(self, xy, text, *, h_align='center', v_align='center', max_width=None, **kwargs):
+    def _shrink_font(self, text, max_width, size_args, min_size):
+        # Largest font size between min_size and the current size that fits, found by bisection.
+        font = size_args['font']
+        low, high = min_size, font.size - 1
+        best = None
+        while low <= high:
+            size = (low + high) // 2
+            candidate = load_font(font.path, size)
+            w, h = super().textsize(text, **dict(size_args, font=candidate))
+            if w <= max_width:
+                best = candidate
+                low = size + 1
+            else:
+                high = size - 1
+        return best
+
+    def _truncate_text(self, text, max_width, size_args, ellipsis):
+        # Longest prefix (plus the ellipsis) that fits, found by bisection.
+        low, high = 0, len(text) - 1
+        best = None
+        while low <= high:
+            length = (low + high) // 2
+            if not ellipsis:
+                candidate = text[:length]
+            elif length:
+                candidate = text[:length].rstrip() + ellipsis
+            else:
+                candidate = ellipsis
+            w, h = super().textsize(candidate, **size_args)
+            if w <= max_width:
+                best = (candidate, w, h)
+                low = length + 1
+            else:
+                high = length - 1
+        if best is None:
+            if ellipsis:
+                return self._truncate_text(text, max_width, size_args, '')
+            return '', 0, super().textsize('', **size_args)[1]
+        return best
+
+    def centertext(self, xy, text, *, h_align='center', v_align='center', max_width=None, min_font_size=None, ellipsis=None, **kwargs):
         self._update_fill(kwargs)
         size_args = {k: kwargs[k] for k in ('font', 'spacing', 'direction', 'features', 'language') if k in kwargs}
         text = self._basic_to_str(text)
 
         w, h = super().textsize(text, **size_args)
-        if max_width is not None:
+        if max_width is not None and w > self.in_to_px(max_width):
             max_width = self.in_to_px(max_width)
-            while text and w > max_width:
-                text = text[:-1]
-                w, h = super().textsize(text, **size_args)
+
+            font = size_args.get('font')
+            if min_font_size is not None and isinstance(getattr(font, 'path', None), str):
+                min_size = self.in_to_px(min_font_size)
+                smaller_font = self._shrink_font(text, max_width, size_args, min_size) if min_size < font.size else None
+                if smaller_font is None and min_size < font.size:
+                    smaller_font = load_font(font.path, min_size)
+                if smaller_font is not None:
+                    size_args['font'] = kwargs['font'] = smaller_font
+                    w, h = super().textsize(text, **size_args)
+
+            if w > max_width:
+                text, w, h = self._truncate_text(text, max_width, size_args, ellipsis or '')
 
         x, y = self.in_to_px(xy)
 
@@ -147,12 +216,19 @@ def _use_color_defaults(image_mode, background_color, foreground_color):
     return background_color, foreground_color
 
 class BadgeTemplate:
+    # A template can draw what's the same on every badge into a static layer, once per template instance and
+    # per distinct value of static_fields, which each badge then starts from instead of a blank image.
+    static_fields = ()
+    _static_draw_func = None
+
     def __init__(self, size, draw_func, *, image_mode=MODE_GRAYSCALE, dpi=DEFAULT_DPI, default_font=None, background_color=None, foreground_color=None):
         self._dpi = float(DEFAULT_DPI)
         self._draw_func = draw_func
         self._size = size
         self._default_font = None
         self._bg_color, self._fg_color = _use_color_defaults(image_mode, background_color, foreground_color)
+        self._static_layers = {}
+        self._static_layers_lock = threading.Lock()
 
     class Renderer:
         def __init__(self, image, draw, dpi, default_font):
@@ -168,7 +244,7 @@ class BadgeTemplate:
                 if self._default_font is None:
                     raise TemplateError('You have to explicitly specify a font when there is no default configured.')
                 font_file = self._default_font
-            self._fonts[alias] = ImageFont.truetype(font_file, in_to_px(size_in, dpi=self._dpi))
+            self._fonts[alias] = load_font(font_file, in_to_px(size_in, dpi=self._dpi))
 
         def font(self, alias):
             return self._fonts[alias]
@@ -176,19 +252,56 @@ class BadgeTemplate:
     def draw_badge(self, renderer, data):
         self._draw_func(renderer, data)
 
-    def render(self, data, fp, format=None):
+    def draw_static(self, renderer, static_data):
+        if self._static_draw_func is not None:
+            self._static_draw_func(renderer, static_data)
+
+    def _new_canvas(self):
         image = Image.new(self._image_mode, in_to_px(self._size, dpi=self._dpi), self._bg_color)
-        draw = ImageDrawInches(image, self._image_mode, fill_color=self._fg_color)
+        draw = ImageDrawInches(image, self._image_mode, dpi=self._dpi, fill_color=self._fg_color)
+        return image, draw
+
+    def _static_layer(self, data):
+        key = tuple(data.get(field) for field in self.static_fields)
+        layer = self._static_layers.get(key)
+        if layer is None:
+            layer, draw = self._new_canvas()
+            self.draw_static(self.Renderer(layer, draw, self._dpi, self._default_font), dict(zip(self.static_fields, key)))
+            with self._static_layers_lock:
+                if len(self._static_layers) >= STATIC_LAYER_CACHE_SIZE:
+                    self._static_layers.clear()
+                self._static_layers[key] = layer
+        return layer
+
+    def render_image(self, data):
+        if self._static_draw_func is None:
+            image, draw = self._new_canvas()
+        else:
+            image = self._static_layer(data).copy()
+            draw = ImageDrawInches(image, self._image_mode, dpi=self._dpi, fill_color=self._fg_color)
         renderer = self.Renderer(image, draw, self._dpi, self._default_font)
         self.draw_badge(renderer, data)
-        image.save(fp, format)
+        return image
+
+    def render(self, data, fp, format=None):
+        self.render_image(data).save(fp, format)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def dpi(self):
+        return self._dpi
 
     @property
     def cups_media(self):
         # Yes, this is intentionally backwards. CUPS is weird.
         return 'Custom.{}x{}in'.format(self._size[1], self._size[0])
 
-def make_template(width_in, height_in, *, image_mode=MODE_GRAYSCALE, dpi=DEFAULT_DPI, default_font=None, background_color=None, foreground_color=None):
+def make_template(width_in, height_in, *, image_mode=MODE_GRAYSCALE, dpi=DEFAULT_DPI, default_font=None, background_color=None, foreground_color=None, static_layer=None, static_fields=()):
+    # static_layer(badge, data) draws the parts of the badge that only depend on the fields named in
+    # static_fields (data only has those), and draw_badge_func draws the rest over it.
     background_color, foreground_color = _use_color_defaults(image_mode, background_color, foreground_color)
 
     def subclass_init(self, *, dpi=dpi, default_font=default_font):
@@ -198,6 +311,8 @@ def make_template(width_in, height_in, *, image_mode=MODE_GRAYSCALE, dpi=DEFAULT
         self._image_mode = image_mode
         self._bg_color = background_color
         self._fg_color = foreground_color
+        self._static_layers = {}
+        self._static_layers_lock = threading.Lock()
 
     def make_template_decorator(draw_badge_func):
         return type(
@@ -205,7 +320,9 @@ def make_template(width_in, height_in, *, image_mode=MODE_GRAYSCALE, dpi=DEFAULT
             (BadgeTemplate,),
             {
                 'draw_badge': lambda self, badge, data: draw_badge_func(badge, data),
-                '__init__': subclass_init
+                '__init__': subclass_init,
+                '_static_draw_func': staticmethod(static_layer) if static_layer is not None else None,
+                'static_fields': tuple(static_fields),
             }
         )
 
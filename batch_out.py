@@ -1,33 +1,197 @@
 import argparse
 import asyncio
+import concurrent.futures
+import functools
 import os
 import printegration
+import raster
 import regfox
+import spool
 import toml
 
-async def main(config_file, confirm_count, printer):
+_worker_templates = None
+_worker_template_file = None
+_worker_encoder = None
+
+def _init_worker(printer_config):
+    # Runs once in each render process. The template module and its fonts stay loaded for the life of the worker.
+    global _worker_templates, _worker_template_file, _worker_encoder
+    _worker_templates = printegration.TemplateRegistry(printer_config['default_font'])
+    _worker_template_file = printer_config['badge_template']
+    _worker_encoder = raster.BadgeEncoder(printer_config)
+    _worker_templates.get(_worker_template_file)
+
+def _render_badge(template_data):
+    badge_template = _worker_templates.get(_worker_template_file)
+    data = _worker_encoder.encode(badge_template.render_image(template_data), badge_template.size, badge_template.dpi)
+    return data, badge_template.cups_media
+
+def _render_page(spool_class, template_data):
+    badge_template = _worker_templates.get(_worker_template_file)
+    page = spool_class.encode_page(badge_template.render_image(template_data))
+    return page, badge_template.size, badge_template.cups_media
+
+class Checkpoint:
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._done = set()
+        self._file = None
+        if file_name is not None and os.path.exists(file_name):
+            with open(file_name, 'r') as checkpoint_file:
+                self._done = {int(line) for line in checkpoint_file if line.strip()}
+
+    def __contains__(self, registrant_id):
+        return registrant_id in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def mark(self, registrant_id):
+        self._done.add(registrant_id)
+        if self._file_name is None:
+            return
+        if self._file is None:
+            self._file = open(self._file_name, 'a')
+        self._file.write('{}\n'.format(registrant_id))
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+def select_registrants(registrants, checkpoint, badge_levels=None, statuses=None, sort_last_name=False):
+    if badge_levels:
+        badge_levels = {level.lower() for level in badge_levels}
+        registrants = [reg for reg in registrants if reg['badgeLevel'].lower() in badge_levels]
+    if statuses:
+        statuses = {status.lower() for status in statuses}
+        registrants = [reg for reg in registrants if reg['status'].lower() in statuses]
+    registrants = [reg for reg in registrants if reg['registrantId'] not in checkpoint]
+    if sort_last_name:
+        registrants.sort(key=lambda reg: (reg['lastName'].lower(), reg['firstName'].lower(), reg['registrantId']))
+    return registrants
+
+async def render_batch(printer_config, template_data_list, render_func, output_func, checkpoint, *, workers=None, queue_size=16):
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(printer_config,)) as render_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as output_thread:
+
+        async def produce():
+            # The queue holds render futures in output order. Its size caps how far rendering runs ahead of the output.
+            try:
+                for template_data in template_data_list:
+                    await queue.put((template_data, loop.run_in_executor(render_pool, render_func, template_data)))
+            except Exception:
+                # Ends the output loop below, which then raises this from the producer instead of waiting forever.
+                await queue.put(None)
+                raise
+            await queue.put(None)
+
+        producer = asyncio.ensure_future(produce())
+        output = await loop.run_in_executor(output_thread, output_func)
+        written = 0
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    await producer
+                    break
+                template_data, rendered = item
+                rendered = await rendered
+                await loop.run_in_executor(output_thread, output, template_data, *rendered)
+                checkpoint.mark(template_data['registrantId'])
+                written += 1
+                print('Sent {} of {}: {} ({})'.format(written, len(template_data_list), template_data['attendeeBadgeName'], template_data['registrantId']))
+        finally:
+            producer.cancel()
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    item[1].cancel()
+    return written
+
+async def render_and_print(printer_config, printer, printer_name, template_data_list, checkpoint, *, workers=None, queue_size=16):
+    def open_printer():
+        def submit(template_data, data, media):
+            printer.submit_document(printer_name, data, 'badge-{}'.format(template_data['registrantId']), media)
+        return submit
+
+    return await render_batch(printer_config, template_data_list, _render_badge, open_printer, checkpoint, workers=workers, queue_size=queue_size)
+
+async def render_and_spool(printer_config, output_spool, template_data_list, checkpoint, *, workers=None, queue_size=16):
+    def open_spool():
+        def add_page(template_data, page, size_in, media):
+            output_spool.add_page(page, size_in, 'badge-{}'.format(template_data['registrantId']), media)
+        return add_page
+
+    render_func = functools.partial(_render_page, type(output_spool))
+    return await render_batch(printer_config, template_data_list, render_func, open_spool, checkpoint, workers=workers, queue_size=queue_size)
+
+async def main(config_file, confirm_count, printer_name, *, badge_levels=None, statuses=None, sort_last_name=False, checkpoint_file=None, workers=None, pdf_file=None, png_directory=None):
     config = toml.load(config_file)
     event_name = config['regfox']['event_name']
-    async with regfox.RegFoxClientSession(api_key=config['regfox']['api_key']) as api:
+    async with regfox.RegFoxClientSession(api_key=config['regfox']['api_key'], service_prefix=config['regfox'].get('service_prefix', regfox.SERVICE_PREFIX)) as api:
         async with regfox.RegFoxCache(api, config['regfox']) as cache:
-            printer = printegration.Printegration(printer or config['printer'])
+            checkpoint = Checkpoint(checkpoint_file)
 
-            registrants = await cache.search_registrants()
+            registrants = select_registrants(await cache.search_registrants(), checkpoint, badge_levels, statuses, sort_last_name)
+            if len(checkpoint):
+                print('Skipping {} badges already listed in {}.'.format(len(checkpoint), checkpoint_file))
 
-            if confirm_count == len(registrants):
-                for registrant in registrants:
-                    template_data = {'eventName': event_name}
-                    template_data.update(registrant)
-                    printer.print_badge(template_data)
-            else:
+            if pdf_file is None and png_directory is None and confirm_count != len(registrants):
                 print('There are {0} badges. If you want to print them, add the option "--confirm-count {0}"'.format(len(registrants)))
+                return
+
+            template_data_list = []
+            for registrant in registrants:
+                template_data = {'eventName': event_name}
+                template_data.update(registrant)
+                template_data_list.append(template_data)
+
+            try:
+                if pdf_file is not None:
+                    with spool.PdfSpool(pdf_file) as output_spool:
+                        await render_and_spool(config['printer'], output_spool, template_data_list, checkpoint, workers=workers)
+                elif png_directory is not None:
+                    with spool.PngSpool(png_directory) as output_spool:
+                        await render_and_spool(config['printer'], output_spool, template_data_list, checkpoint, workers=workers)
+                else:
+                    printer = printegration.Printegration(config['printer'])
+                    printer_name = printer.verify_printer_name(printer_name)
+                    await render_and_print(config['printer'], printer, printer_name, template_data_list, checkpoint, workers=workers)
+            finally:
+                checkpoint.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--configuration', '-c', type=os.path.realpath, required=True, help='Configuration File')
     parser.add_argument('--confirm-count', type=int, default=None, required=False, help='Used to make sure you want to spit out a lot of labels.')
     parser.add_argument('--printer', default=None, required=False, help='Specify the CUPS printer to use. (Default in config file is used if not specified.)')
+    parser.add_argument('--badge-level', action='append', default=None, help='Only print badges of this level. (Can be given more than once.)')
+    parser.add_argument('--status', action='append', default=None, help='Only print badges with this registration status, e.g. completed. (Can be given more than once.)')
+    parser.add_argument('--sort-last-name', action='store_true', help='Print in last name order instead of registration order.')
+    parser.add_argument('--checkpoint', default=None, required=False, help='File that records every badge sent to the printer. Badges already listed in it are skipped, so a jammed run can be resumed.')
+    parser.add_argument('--workers', type=int, default=None, required=False, help='Number of render processes. (Defaults to the number of CPUs.)')
+    output_group = parser.add_mutually_exclusive_group()
+    output_group.add_argument('--pdf', dest='pdf_file', default=None, required=False, help='Write every badge into this multi-page PDF instead of printing them.')
+    output_group.add_argument('--png-dir', dest='png_directory', default=None, required=False, help='Write every badge as a PNG into this directory, along with a manifest.csv, instead of printing them.')
     args = parser.parse_args()
 
+    if args.pdf_file is not None and args.checkpoint is not None:
+        parser.error('--checkpoint can\'t resume a PDF. Use --png-dir or start the PDF over.')
+
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main(args.configuration, args.confirm_count, args.printer))
+    loop.run_until_complete(main(
+        args.configuration,
+        args.confirm_count,
+        args.printer,
+        badge_levels=args.badge_level,
+        statuses=args.status,
+        sort_last_name=args.sort_last_name,
+        checkpoint_file=args.checkpoint,
+        workers=args.workers,
+        pdf_file=args.pdf_file,
+        png_directory=args.png_directory,
+    ))
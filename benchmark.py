@@ -0,0 +1,360 @@
+import aiohttp
+import aiohttp.web
+import analytics
+import argparse
+import asyncio
+import datetime
+import fakeregfox
+import itertools
+import json
+import os
+import platform
+import raster
+import regfox
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import toml
+import types
+
+# Times the pieces that matter at the door (sync, search, counts, rendering and check-in to print) against
+# fakeregfox.py and a fake CUPS, so runs can be compared between versions without an API key or a printer.
+# Results are written as JSON. Pass an earlier result to --compare to see what changed.
+
+BENCHMARKS = ('sync_full', 'sync_incremental', 'search', 'get_counts', 'analytics', 'render', 'checkin_print')
+FAKE_PRINTER_NAME = 'Benchmark-Printer'
+
+class FakeCupsConnection:
+    # Just enough of cups.Connection for printegration.py. Every job "prints" after print_delay seconds.
+    print_delay = 0.0
+    _job_ids = itertools.count(1)
+    _lock = threading.Lock()
+    jobs = {}
+
+    def getPrinters(self):
+        return {FAKE_PRINTER_NAME: {'printer-info': 'Fake printer', 'printer-make-and-model': 'Benchmark'}}
+
+    def createJob(self, printer, title, options):
+        with self._lock:
+            job_id = next(self._job_ids)
+            self.jobs[job_id] = {'printer': printer, 'title': title, 'options': options, 'bytes': 0, 'finished': None}
+        return job_id
+
+    def startDocument(self, printer, job_id, doc_name, format, last_document):
+        self._current = job_id
+
+    def writeRequestData(self, data, length):
+        self.jobs[self._current]['bytes'] += length
+
+    def finishDocument(self, printer):
+        time.sleep(self.print_delay)
+        self.jobs[self._current]['finished'] = time.time()
+
+    def getJobAttributes(self, job_id, requested_attributes=None):
+        return {'job-state': 9, 'job-state-reasons': 'job-completed-successfully'}
+
+def install_fake_cups(print_delay=0.0):
+    # Has to run before printegration (or anything that imports it) is imported.
+    FakeCupsConnection.print_delay = print_delay
+    module = types.ModuleType('cups')
+    module.Connection = FakeCupsConnection
+    module.IPPError = type('IPPError', (Exception,), {})
+    module.HTTPError = type('HTTPError', (Exception,), {})
+    module.CUPS_FORMAT_AUTO = 'application/octet-stream'
+    module.CUPS_FORMAT_RAW = 'application/vnd.cups-raw'
+    module.IPP_INTERNAL_ERROR = 0x0500
+    module.IPP_SERVICE_UNAVAILABLE = 0x0502
+    sys.modules['cups'] = module
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'p95_ms': samples[min(int(len(samples) * 0.95), len(samples) - 1)] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+class BenchmarkRun:
+    def __init__(self, args):
+        self._args = args
+        self._fake = fakeregfox.FakeRegFox(args.registrants, latency=args.latency)
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._service_prefix = None
+        self._api = None
+        self._cache = None
+
+    def regfox_config(self):
+        if self._args.database == 'file':
+            database_file = os.path.join(self._temp_dir.name, 'benchmark.sqlite')
+        else:
+            database_file = self._args.database
+        return {
+            'event_name': 'Benchmark Con',
+            'api_key': 'benchmark',
+            'form_id': self._fake.form_id,
+            'start_date': '2020-01-01',
+            'database_file': database_file,
+            'service_prefix': self._service_prefix,
+        }
+
+    def printer_config(self):
+        return {
+            'printer_name': FAKE_PRINTER_NAME,
+            'default_font': self._args.font,
+            'badge_template': self._args.template,
+            'output_format': self._args.output_format,
+        }
+
+    async def __aenter__(self):
+        self._service_prefix = await self._fake.start()
+        self._api = regfox.RegFoxClientSession(api_key='benchmark', service_prefix=self._service_prefix)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._cache is not None:
+            await self._cache.close()
+        await self._api.close()
+        await self._fake.stop()
+        self._temp_dir.cleanup()
+
+    async def _timed_sync(self, rebuild=False):
+        requests = self._fake.requests
+        start = time.perf_counter()
+        await self._cache.sync(rebuild=rebuild)
+        return time.perf_counter() - start, self._fake.requests - requests
+
+    async def sync_full(self):
+        self._cache = await regfox.RegFoxCache.construct(self._api, self.regfox_config())
+        elapsed, requests = await self._timed_sync()
+        return {
+            'registrants': self._args.registrants,
+            'seconds': elapsed,
+            'registrants_per_second': self._args.registrants / elapsed,
+            'api_requests': requests,
+        }
+
+    async def sync_incremental(self):
+        changed = self._fake.touch_registrants(self._args.changed)
+        elapsed, requests = await self._timed_sync()
+        return {
+            'changed': len(changed),
+            'seconds': elapsed,
+            'api_requests': requests,
+        }
+
+    def _search_queries(self):
+        sample = self._fake._registrants[self._fake.registrant_ids[len(self._fake.registrant_ids) // 2]]
+        email = next(datum['value'] for datum in sample['fieldData'] if datum['path'] == 'email')
+        return {
+            'all': '',
+            'display_id': sample['displayId'],
+            'email': email,
+            'one_word': 'fox',
+            'prefix': 'spark',
+            'two_words': 'alex wolf',
+            'no_match': 'zzzzzz',
+        }
+
+    async def search(self):
+        results = {}
+        for name, criteria in self._search_queries().items():
+            samples = []
+            found = 0
+            for iteration in range(self._args.iterations):
+                start = time.perf_counter()
+                found = len(await self._cache.search_registrants(criteria, 100))
+                samples.append(time.perf_counter() - start)
+            results[name] = dict(summarize(samples), found=found)
+
+        samples = []
+        for iteration in range(self._args.iterations):
+            start = time.perf_counter()
+            await self._cache.search_registrants_page('fox', 100)
+            samples.append(time.perf_counter() - start)
+        results['page'] = summarize(samples)
+        return results
+
+    async def get_counts(self):
+        results = {}
+        for name, invalidate in (('cached', False), ('recount', True)):
+            samples = []
+            for iteration in range(self._args.iterations):
+                if invalidate:
+                    self._cache._invalidate_counts()
+                start = time.perf_counter()
+                await self._cache.get_counts()
+                samples.append(time.perf_counter() - start)
+            results[name] = summarize(samples)
+        return results
+
+    async def analytics(self):
+        snapshot = analytics.RegistrantSnapshot(self._cache, self._cache.start_date)
+        start = time.perf_counter()
+        await snapshot.start()
+        load_seconds = time.perf_counter() - start
+        samples = []
+        for iteration in range(self._args.iterations):
+            start = time.perf_counter()
+            snapshot.summary()
+            samples.append(time.perf_counter() - start)
+        await snapshot.close()
+        return {
+            'numpy': analytics.numpy is not None,
+            'load_seconds': load_seconds,
+            'summary': summarize(samples),
+        }
+
+    async def render(self):
+        import printegration
+
+        registry = printegration.TemplateRegistry(self._args.font)
+        badge_template = registry.get(self._args.template)
+        encoder = raster.BadgeEncoder(self.printer_config())
+        registrants = await self._cache.search_registrants('', self._args.renders)
+        samples = []
+        output_bytes = 0
+        for registrant in registrants:
+            template_data = dict(registrant, eventName='Benchmark Con')
+            start = time.perf_counter()
+            data = encoder.encode(badge_template.render_image(template_data), badge_template.size, badge_template.dpi)
+            samples.append(time.perf_counter() - start)
+            output_bytes += len(data)
+        return dict(summarize(samples), mean_document_bytes=output_bytes / max(len(samples), 1))
+
+    def _frontend_config_file(self):
+        config = {
+            'regfox': self.regfox_config(),
+            'printer': self.printer_config(),
+            'frontend': {'update_period': 3600, 'port': 0},
+        }
+        if config['regfox']['database_file'] != ':memory:':
+            config['regfox']['database_file'] = os.path.join(self._temp_dir.name, 'frontend.sqlite')
+        config_file = os.path.join(self._temp_dir.name, 'frontend.toml')
+        with open(config_file, 'w') as config_out:
+            toml.dump(config, config_out)
+        return config_file
+
+    async def checkin_print(self):
+        import frontend
+
+        server = frontend.Frontend(self._frontend_config_file())
+        runner = aiohttp.web.AppRunner(server.make_app())
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        base_url = 'http://127.0.0.1:{}'.format(runner.addresses[0][1])
+
+        checkin_samples = []
+        total_samples = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                async def get_json(path, **params):
+                    async with session.get(base_url + path, params=params) as response:
+                        return await response.json()
+
+                # Wait for the frontend's first sync.
+                while (await get_json('/get_counts'))['total'] == 0:
+                    await asyncio.sleep(0.1)
+
+                page = await get_json('/query', criteria='', after='', limit=str(self._args.checkins * 2))
+                candidates = [reg for reg in page['registrants'] if reg['status'] == 'completed' and not reg['checkedIn']]
+                for registrant in candidates[:self._args.checkins]:
+                    start = time.perf_counter()
+                    await get_json('/checkin_badge', id=str(registrant['registrantId']))
+                    checkin_samples.append(time.perf_counter() - start)
+                    job = await get_json('/print_badge', id=str(registrant['registrantId']), name=FAKE_PRINTER_NAME)
+                    while job['state'] not in ('sent', 'failed'):
+                        await asyncio.sleep(0.005)
+                        job = (await get_json('/print_jobs', id=str(job['jobId'])))['jobs'][0]
+                    total_samples.append(time.perf_counter() - start)
+        finally:
+            await runner.cleanup()
+
+        return {
+            'checkin': summarize(checkin_samples),
+            'checkin_to_sent': summarize(total_samples),
+        }
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, '{}{}.'.format(prefix, key))
+        elif isinstance(value, (int, float)):
+            yield '{}{}'.format(prefix, key), value
+
+def compare(baseline, current):
+    old = dict(flatten(baseline['results']))
+    print('{:55} {:>12} {:>12} {:>8}'.format('metric', 'baseline', 'current', 'change'))
+    for key, value in flatten(current['results']):
+        if key not in old or not (key.endswith('_ms') or key.endswith('seconds')):
+            continue
+        change = '' if not old[key] else '{:+.1f}%'.format((value - old[key]) / old[key] * 100)
+        print('{:55} {:12.3f} {:12.3f} {:>8}'.format(key, old[key], value, change))
+
+async def main(args):
+    results = {}
+    async with BenchmarkRun(args) as run:
+        # sync_full has to run first. Everything after it uses the cache it fills.
+        for name in BENCHMARKS:
+            if name != 'sync_full' and args.only and name not in args.only:
+                continue
+            print('Running {}...'.format(name), file=sys.stderr)
+            results[name] = await getattr(run, name)()
+
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': regfox.sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--registrants', type=int, default=1000, help='Number of registrants the fake API makes up.')
+    parser.add_argument('--changed', type=int, default=100, help='Number of registrants changed before the incremental sync.')
+    parser.add_argument('--iterations', type=int, default=50, help='Times each search and count is repeated.')
+    parser.add_argument('--renders', type=int, default=50, help='Number of badges to render.')
+    parser.add_argument('--checkins', type=int, default=20, help='Number of check-in and print round trips.')
+    parser.add_argument('--database', default=':memory:', help='":memory:" or "file" for a database in a temporary directory.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the fake API waits before answering.')
+    parser.add_argument('--print-delay', type=float, default=0.05, help='Seconds the fake printer takes per job.')
+    parser.add_argument('--template', default='GenericBadge.py', help='Badge template to render.')
+    parser.add_argument('--output-format', default='png', choices=tuple(raster.DOCUMENT_FORMATS), help='Document format badges are encoded to.')
+    parser.add_argument('--font', default='LiberationSansNarrow-Regular.ttf', help='Default font for the template.')
+    parser.add_argument('--only', action='append', choices=BENCHMARKS, default=None, help='Only run this benchmark. (Can be given more than once. sync_full always runs.)')
+    parser.add_argument('--output', '-o', default=None, help='Write the JSON results here instead of to stdout.')
+    parser.add_argument('--compare', default=None, help='Earlier JSON results to compare against.')
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    install_fake_cups(args.print_delay)
+
+    loop = asyncio.get_event_loop()
+    report = loop.run_until_complete(main(args))
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as baseline_file:
+            compare(json.load(baseline_file), report)
@@ -0,0 +1,290 @@
+import aiohttp
+import aiohttp.web
+import asyncio
+import collections
+import json
+import metrics
+import os
+import regfox
+import serialize
+import time
+import uuid
+
+# Several check-in stations sharing one view of the registrants. One node, the leader, syncs with RegFox and
+# keeps a log of what changed. Every other node long-polls the leader's /cluster/changes and writes the rows it
+# gets into its own cache, and sends the leader its check-ins through its check-in outbox. Only the leader
+# spends API requests, however many stations there are.
+#
+# The leader is whoever holds the lease in lock_file (on a volume every station can see), renewed every few
+# seconds and taken over once it expires. Or leader_url names it outright.
+
+CLUSTER_IS_LEADER = metrics.gauge('cluster_is_leader', '1 if this node syncs with RegFox for the cluster.')
+CLUSTER_ROWS_APPLIED = metrics.counter('cluster_rows_applied', 'Rows copied from the leader into this cache.')
+
+SECRET_HEADER = 'X-Cluster-Secret'
+
+class LeaseFile:
+    def __init__(self, file_name, node_id, url, lease_seconds):
+        self._file_name = file_name
+        self._node_id = node_id
+        self._url = url
+        self._lease_seconds = lease_seconds
+
+    def read(self):
+        try:
+            with open(self._file_name, 'r') as lease_file:
+                return json.load(lease_file)
+        except (OSError, ValueError):
+            return None
+
+    def claim(self):
+        # Returns the URL of whoever holds the lease, after taking or renewing it if nobody else holds it.
+        lease = self.read()
+        if lease is not None and lease.get('node') != self._node_id and lease.get('expires', 0) > time.time():
+            return lease.get('url')
+
+        # Written to the side and renamed over, so nobody ever reads half a lease.
+        temp_name = '{}.{}.tmp'.format(self._file_name, self._node_id)
+        with open(temp_name, 'w') as lease_file:
+            json.dump({'node': self._node_id, 'url': self._url, 'expires': time.time() + self._lease_seconds}, lease_file)
+        os.replace(temp_name, self._file_name)
+        return self._url
+
+    def holder(self):
+        lease = self.read()
+        return None if lease is None else lease.get('node')
+
+    def release(self):
+        # So another station can take over right away instead of waiting for the lease to run out.
+        if self.holder() == self._node_id:
+            os.remove(self._file_name)
+
+class ClusterNode:
+    # How many changes the leader remembers. A follower further behind than this gets every row again.
+    CHANGE_LOG_SIZE = 1000
+
+    def __init__(self, config, cache, run_sync):
+        cluster_config = config['cluster']
+        self._cache = cache
+        self._run_sync = run_sync
+        self._node_id = uuid.uuid4().hex
+        self.url = cluster_config['advertise_url'].rstrip('/')
+        self._secret = cluster_config.get('secret', None)
+        self._lease_seconds = cluster_config.get('lease_seconds', 15)
+        self._poll_seconds = cluster_config.get('poll_seconds', 25)
+        self._static_leader = cluster_config.get('leader_url', None)
+        # A snapshot of every row is big, so it goes out the way the frontend's own responses do.
+        self._responder = serialize.JsonResponder(config.get('frontend', {}))
+        if self._static_leader is not None:
+            self._static_leader = self._static_leader.rstrip('/')
+            self._lease = None
+        else:
+            self._lease = LeaseFile(cluster_config['lock_file'], self._node_id, self.url, self._lease_seconds)
+
+        self.leader_url = None
+        self._sync_task = None
+        self._follow_task = None
+        self._run_task = None
+        self._session = None
+        self._closing = False
+
+        # The leader's side: numbered changes, and an event that's set (and replaced) whenever one is added.
+        self._sequence = 0
+        self._changes = collections.deque(maxlen=self.CHANGE_LOG_SIZE)
+        self._changed = asyncio.Event()
+
+        # The follower's side: the leader's node id and the last change number applied from it.
+        self._leader_epoch = None
+        self._applied = 0
+
+    @property
+    def is_leader(self):
+        return self.leader_url == self.url
+
+    def _headers(self):
+        return {SECRET_HEADER: self._secret} if self._secret is not None else {}
+
+    async def start(self):
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self._poll_seconds + 10), headers=self._headers())
+        self._cache.add_listener(self._cache_changed)
+        self._run_task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        self._closing = True
+        self._changed.set()
+        self._cache.remove_listener(self._cache_changed)
+        for task in (self._run_task, self._sync_task, self._follow_task):
+            if task is not None:
+                task.cancel()
+        await self._session.close()
+        if self._lease is not None and self.is_leader:
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._lease.release)
+            except OSError as e:
+                print('CLUSTER: unable to release the lease: {}'.format(e))
+
+    async def _elect(self):
+        if self._lease is None:
+            return self._static_leader
+
+        loop = asyncio.get_event_loop()
+        was_leader = self.is_leader
+        leader_url = await loop.run_in_executor(None, self._lease.claim)
+        if leader_url == self.url and not was_leader:
+            # Two nodes can both find the lease expired and both write it. Whoever renamed last holds it.
+            await asyncio.sleep(1)
+            if await loop.run_in_executor(None, self._lease.holder) != self._node_id:
+                leader_url = (await loop.run_in_executor(None, self._lease.read) or {}).get('url')
+        return leader_url
+
+    async def _run(self):
+        while True:
+            try:
+                leader_url = await self._elect()
+            except OSError as e:
+                print('CLUSTER: unable to read the lease: {}'.format(e))
+                leader_url = None
+            if leader_url != self.leader_url:
+                self._change_leader(leader_url)
+            await asyncio.sleep(self._lease_seconds / 3)
+
+    def _change_leader(self, leader_url):
+        print('CLUSTER: leader is now {}{}'.format(leader_url, ' (this node)' if leader_url == self.url else ''))
+        was_leader = self.is_leader
+        self.leader_url = leader_url
+
+        if self._follow_task is not None:
+            self._follow_task.cancel()
+            self._follow_task = None
+
+        if self.is_leader:
+            CLUSTER_IS_LEADER.set(1)
+            self._cache.set_outbox_sender(None)
+            self._cache.set_registrant_updater(None)
+            self._sync_task = asyncio.ensure_future(self._run_sync())
+            return
+
+        CLUSTER_IS_LEADER.set(0)
+        if was_leader and self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+        self._cache.set_outbox_sender(self._forward_checkin)
+        self._cache.set_registrant_updater(self._update_from_leader)
+        if leader_url is not None:
+            self._follow_task = asyncio.ensure_future(self._follow(leader_url))
+
+    def _cache_changed(self, event, registrant_ids):
+        self._sequence += 1
+        self._changes.append((self._sequence, None if event == 'reload' else list(registrant_ids)))
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _changes_after(self, after):
+        # The registrantIds changed since change number after, or None if that's too far back to say.
+        if self._changes and after < self._changes[0][0] - 1:
+            return None
+        changed = set()
+        for sequence, registrant_ids in self._changes:
+            if sequence <= after:
+                continue
+            if registrant_ids is None:
+                return None
+            changed.update(registrant_ids)
+        return changed
+
+    async def _follow(self, leader_url):
+        retry = 1
+        while True:
+            try:
+                params = {'after': self._applied, 'epoch': self._leader_epoch or '', 'wait': self._poll_seconds}
+                async with self._session.get(leader_url + '/cluster/changes', params=params) as response:
+                    response.raise_for_status()
+                    batch = await response.json()
+                await self._cache.apply_rows(batch['rows'], replace=batch['snapshot'], marks=batch['marks'])
+                CLUSTER_ROWS_APPLIED.inc(len(batch['rows']))
+                self._leader_epoch = batch['epoch']
+                self._applied = batch['sequence']
+                retry = 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print('CLUSTER: unable to get changes from {}: {}'.format(leader_url, e))
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, self._lease_seconds)
+
+    async def _forward_checkin(self, registrant_id, date_checked_in):
+        if self.leader_url is None:
+            raise aiohttp.ClientError('No cluster leader to send check-ins to.')
+        async with self._session.post(self.leader_url + '/cluster/checkin', json={'id': registrant_id, 'date': date_checked_in}) as response:
+            response.raise_for_status()
+            registrant = await response.json()
+        if registrant and registrant.get('checkedIn'):
+            return regfox.OUTBOX_SENT, None
+        return regfox.OUTBOX_CONFLICT, 'The leader was unable to check in {}.'.format(registrant_id)
+
+    async def _update_from_leader(self, registrant_id):
+        # The leader asks RegFox and hands back the row, so a follower never spends API requests of its own.
+        if self.leader_url is None:
+            raise aiohttp.ClientError('No cluster leader to update {} from.'.format(registrant_id))
+        async with self._session.post(self.leader_url + '/cluster/update', json={'id': registrant_id}) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    def _check_secret(self, request):
+        if self._secret is not None and request.headers.get(SECRET_HEADER) != self._secret:
+            raise aiohttp.web.HTTPForbidden()
+
+    async def changes(self, request):
+        self._check_secret(request)
+        try:
+            after = int(request.query.get('after', 0))
+            wait = min(float(request.query.get('wait', 0)), self._poll_seconds)
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest()
+
+        snapshot = request.query.get('epoch') != self._node_id or after > self._sequence
+        if not snapshot and after == self._sequence and wait > 0:
+            try:
+                await asyncio.wait_for(self._changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+        if self._closing:
+            # The cache is about to close. The follower will try again, maybe somewhere else.
+            raise aiohttp.web.HTTPServiceUnavailable()
+
+        sequence = self._sequence
+        changed = None if snapshot else self._changes_after(after)
+        if changed is None:
+            rows = await self._cache.get_rows()
+        else:
+            rows = await self._cache.get_rows(changed)
+        return await self._responder.respond(request, {
+            'epoch': self._node_id,
+            'sequence': sequence,
+            'snapshot': changed is None,
+            'marks': await self._cache.get_sync_marks(),
+            'rows': rows,
+        })
+
+    async def checkin(self, request):
+        self._check_secret(request)
+        body = await request.json()
+        registrant = await self._cache.checkin_registrant(int(body['id']), self._cache.datetime_from_database(body['date']))
+        return await self._responder.respond(request, registrant)
+
+    async def update(self, request):
+        self._check_secret(request)
+        body = await request.json()
+        registrant_id = int(body['id'])
+        rows = await self._cache.get_rows([registrant_id]) if await self._cache.update_registrant(registrant_id) else []
+        return await self._responder.respond(request, rows[0] if rows else None)
+
+    async def status(self, request):
+        self._check_secret(request)
+        return await self._responder.respond(request, {
+            'node': self.url,
+            'leader': self.leader_url,
+            'isLeader': self.is_leader,
+            'sequence': self._sequence,
+            'applied': self._applied,
+        })
@@ -0,0 +1,229 @@
+import aiohttp.web
+import asyncio
+import bisect
+import datetime
+import functools
+import math
+import random
+import time
+
+# A stand-in for the parts of the Webconnex API that regfox.py uses, so sync, search and check-in can be run
+# and timed without an API key or a network. Point RegFoxClientSession(service_prefix=...) (or service_prefix
+# in the config file) at it.
+
+FIRST_NAMES = ('Alex', 'Sam', 'Jordan', 'Taylor', 'Casey', 'Riley', 'Morgan', 'Quinn', 'Avery', 'Rowan', 'Skyler', 'Jesse')
+LAST_NAMES = ('Fox', 'Wolf', 'Otter', 'Lynx', 'Raccoon', 'Badger', 'Husky', 'Dragon', 'Gryphon', 'Tiger', 'Coyote', 'Hare')
+BADGE_WORDS = ('Fuzzy', 'Sparkle', 'Midnight', 'Thunder', 'Maple', 'Copper', 'Velvet', 'Pixel', 'Ember', 'Frost')
+BADGE_LEVELS = (('Basic', 70), ('Sponsor', 20), ('Super Sponsor', 8), ('Staff', 2))
+STATUSES = (('completed', 95), ('pending', 3), ('refunded', 2))
+
+def _regfox_datetime(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+
+@functools.lru_cache(maxsize=None)
+def _parse_regfox_datetime(value):
+    return datetime.datetime.strptime(value.rstrip('Z').split('.')[0], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+
+def _weighted(rng, choices):
+    return rng.choices([value for value, weight in choices], [weight for value, weight in choices])[0]
+
+class FakeRegFox:
+    def __init__(self, count=1000, *, form_id=1, page_size=50, burst_limit=None, daily_limit=100000, latency=0.0, seed=0):
+        self.form_id = form_id
+        self.page_size = page_size
+        self.latency = latency
+        self.burst_limit = burst_limit
+        self.daily_limit = daily_limit
+        self.requests = 0
+        self.check_ins = 0
+        self._rng = random.Random(seed)
+        self._clock = int(time.time()) - 86400
+        self._registrants = {}
+        self._orders = {}
+        # Ids in ascending order, so paging doesn't have to sort or scan everything before startingAfter.
+        self._registrant_ids = []
+        self._order_ids = []
+        self._burst = []
+        self._runner = None
+        self.add_registrants(count)
+
+    def _tick(self):
+        # Every change gets its own second, since dateUpdated only has one second resolution.
+        self._clock += 1
+        return self._clock
+
+    def add_registrants(self, count):
+        rng = self._rng
+        next_id = max(self._registrants, default=100000) + 1
+        for registrant_id in range(next_id, next_id + count):
+            now = _regfox_datetime(self._tick())
+            order_id = registrant_id * 10
+            first_name = rng.choice(FIRST_NAMES)
+            last_name = rng.choice(LAST_NAMES)
+            badge_level = _weighted(rng, BADGE_LEVELS)
+            self._orders[order_id] = {
+                'id': order_id,
+                'formId': self.form_id,
+                'billing': {'address': {'country': 'US', 'postalCode': '{:05d}'.format(rng.randrange(100000))}},
+                'dateCreated': now,
+                'dateUpdated': now,
+            }
+            self._order_ids.append(order_id)
+            self._registrant_ids.append(registrant_id)
+            self._registrants[registrant_id] = {
+                'id': registrant_id,
+                'displayId': 'RF{:08d}'.format(registrant_id),
+                'orderId': order_id,
+                'formId': self.form_id,
+                'status': _weighted(rng, STATUSES),
+                'checkedIn': False,
+                'dateCheckedIn': None,
+                'dateCreated': now,
+                'dateUpdated': now,
+                'fieldData': [
+                    {'path': 'registrationOptions', 'value': badge_level.lower().replace(' ', ''), 'label': 'Registration Options'},
+                    {'path': 'registrationOptions.option1', 'value': badge_level.lower().replace(' ', ''), 'label': badge_level},
+                    {'path': 'name.first', 'value': first_name, 'label': 'First Name'},
+                    {'path': 'name.last', 'value': last_name, 'label': 'Last Name'},
+                    {'path': 'email', 'value': '{}.{}{}@example.com'.format(first_name, last_name, registrant_id).lower(), 'label': 'Email'},
+                    {'path': 'attendeeBadgeName', 'value': '{} {}'.format(rng.choice(BADGE_WORDS), rng.choice(LAST_NAMES)), 'label': 'Badge Name'},
+                    {'path': 'dateOfBirth', 'value': '{:04d}-{:02d}-{:02d}'.format(rng.randint(1960, 2005), rng.randint(1, 12), rng.randint(1, 28)), 'label': 'Date of Birth'},
+                    {'path': 'phone', 'value': '555{:07d}'.format(rng.randrange(10000000)), 'label': 'Phone'},
+                ],
+            }
+
+    def touch_registrants(self, count):
+        # Changes the badge name on count random registrants, like attendees fixing typos before the event.
+        changed = self._rng.sample(list(self._registrants), min(count, len(self._registrants)))
+        for registrant_id in changed:
+            registrant = self._registrants[registrant_id]
+            for datum in registrant['fieldData']:
+                if datum['path'] == 'attendeeBadgeName':
+                    datum['value'] = '{} {}'.format(self._rng.choice(BADGE_WORDS), self._rng.choice(LAST_NAMES))
+            registrant['dateUpdated'] = _regfox_datetime(self._tick())
+        return changed
+
+    @property
+    def registrant_ids(self):
+        return list(self._registrants)
+
+    def _limit_headers(self):
+        now = time.time()
+        self._burst = [stamp for stamp in self._burst if stamp > now - 1]
+        burst_limit = self.burst_limit or 1000000
+        return {
+            'X-Burst-Limit': str(burst_limit),
+            'X-Burst-Remaining': str(max(burst_limit - len(self._burst), 0)),
+            # When the oldest request in the window stops counting, rounded up to the whole second.
+            'X-Burst-Limit-Reset': str(math.ceil(min(self._burst, default=now) + 1)),
+            'X-Daily-Limit': str(self.daily_limit),
+            'X-Daily-Remaining': str(max(self.daily_limit - self.requests, 0)),
+            'X-Daily-Limit-Reset': str(int(now) + 86400),
+        }
+
+    async def _respond(self, body, status=200):
+        self.requests += 1
+        self._burst.append(time.time())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        headers = self._limit_headers()
+        if self.burst_limit is not None and len(self._burst) > self.burst_limit:
+            return aiohttp.web.json_response({'responseCode': 429, 'message': 'Too Many Requests'}, status=429, headers=headers)
+        return aiohttp.web.json_response(body, status=status, headers=headers)
+
+    def _page(self, items, ids, query):
+        start = 0
+        if 'startingAfter' in query:
+            start = bisect.bisect_right(ids, int(query['startingAfter']))
+        form_id = query.get('formId')
+        updated_after = _parse_regfox_datetime(query['dateUpdatedAfter']) if 'dateUpdatedAfter' in query else None
+        limit = min(int(query.get('limit', self.page_size)), self.page_size)
+
+        # Collect one more than a page to know whether there's another one.
+        page = []
+        for index in range(start, len(ids)):
+            item = items[ids[index]]
+            if form_id is not None and str(item['formId']) != form_id:
+                continue
+            if updated_after is not None and _parse_regfox_datetime(item['dateUpdated']) <= updated_after:
+                continue
+            page.append(item)
+            if len(page) > limit:
+                break
+
+        has_more = len(page) > limit
+        page = page[:limit]
+        return {
+            'responseCode': 200,
+            'data': page,
+            'hasMore': has_more,
+            'startingAfter': page[-1]['id'] if page else None,
+        }
+
+    def _search(self, items, ids):
+        async def handler(request):
+            if 'id' in request.match_info:
+                item = items.get(int(request.match_info['id']))
+                if item is None:
+                    return await self._respond({'responseCode': 404, 'message': 'Not Found'}, 404)
+                return await self._respond({'responseCode': 200, 'data': item})
+            return await self._respond(self._page(items, ids, request.query))
+        return handler
+
+    async def _forms(self, request):
+        return await self._respond({'responseCode': 200, 'data': [{'id': self.form_id, 'name': 'Benchmark Con'}]})
+
+    async def _check_in(self, request):
+        body = await request.json()
+        registrant = self._registrants.get(body.get('id'))
+        if registrant is None:
+            return await self._respond({'responseCode': 404, 'message': 'Registrant not found'}, 404)
+        if registrant['status'] != 'completed':
+            return await self._respond({'responseCode': 400, 'message': 'Registrant is {}'.format(registrant['status'])}, 400)
+        self.check_ins += 1
+        registrant['checkedIn'] = True
+        registrant['dateCheckedIn'] = body.get('date', _regfox_datetime(time.time()))
+        registrant['dateUpdated'] = _regfox_datetime(self._tick())
+        return await self._respond({'responseCode': 200, 'data': {'id': registrant['id'], 'date': registrant['dateCheckedIn']}})
+
+    def make_app(self):
+        app = aiohttp.web.Application()
+        app.add_routes([
+            aiohttp.web.get('/forms', self._forms),
+            aiohttp.web.get('/search/registrants', self._search(self._registrants, self._registrant_ids)),
+            aiohttp.web.get('/search/registrants/{id}', self._search(self._registrants, self._registrant_ids)),
+            aiohttp.web.get('/search/orders', self._search(self._orders, self._order_ids)),
+            aiohttp.web.get('/search/orders/{id}', self._search(self._orders, self._order_ids)),
+            aiohttp.web.post('/registrant/check-in', self._check_in),
+        ])
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        # Returns the service_prefix to hand to RegFoxClientSession. port=0 picks a free port.
+        self._runner = aiohttp.web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = aiohttp.web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return 'http://{}:{}'.format(host, port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=1000, help='Number of registrants to make up.')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port to listen on.')
+    parser.add_argument('--form-id', type=int, default=1, help='Form ID the registrants belong to.')
+    parser.add_argument('--page-size', type=int, default=50, help='Most results returned per page.')
+    parser.add_argument('--burst-limit', type=int, default=None, help='Answer 429 past this many requests per second.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering each request.')
+    args = parser.parse_args()
+
+    fake = FakeRegFox(args.count, form_id=args.form_id, page_size=args.page_size, burst_limit=args.burst_limit, latency=args.latency)
+    print('Set service_prefix = "http://127.0.0.1:{}" in the [regfox] section of your config.'.format(args.port))
+    aiohttp.web.run_app(fake.make_app(), port=args.port)
@@ -1,16 +1,40 @@
 import asyncio
 import aiohttp
 import aiohttp.web
+import analytics
+import cluster
+import concurrent.futures
+import datetime
 import json
+import metrics
 import os
 import printegration
+import printqueue
 import regfox
+import serialize
 import ssl
 import toml
+import time
+import uuid
+
+HTTP_REQUEST_SECONDS = metrics.histogram('frontend_request_seconds', 'Time to handle a request, up to the response being prepared.', ('handler', 'status'))
+API_QUOTA_REMAINING = metrics.gauge('regfox_api_quota_remaining', 'RegFox API requests left in the current window.', ('window',))
+API_QUOTA_LIMIT = metrics.gauge('regfox_api_quota_limit', 'RegFox API requests allowed per window.', ('window',))
+API_QUOTA_RESET_SECONDS = metrics.gauge('regfox_api_quota_reset_seconds', 'Seconds until the RegFox API window resets.', ('window',))
+API_WAITING = metrics.gauge('regfox_api_waiting_requests', 'RegFox API requests waiting on the rate limiter.')
+PRINT_QUEUE_PENDING = metrics.gauge('print_queue_pending_jobs', 'Jobs waiting for their printer.', ('printer',))
+EVENT_CLIENTS = metrics.gauge('frontend_event_clients', 'Browsers connected to /events.')
 
 class Frontend:
+    # Bigger changes than this are sent to the browsers as a reload instead of a row by row diff.
+    MAX_EVENT_ROWS = 200
+
     def __init__(self, config_file):
         self._config = toml.load(config_file)
+        self._event_queues = set()
+        self._prerender_ids = set()
+        self._prerender_all = False
+        self._prerender_task = None
         if 'ssl' in self._config['frontend']:
             self._ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
             self._ssl.load_cert_chain(
@@ -22,13 +46,42 @@ class Frontend:
             self._ssl.options |= ssl.OP_NO_TLSv1_1
         else:
             self._ssl = None
+        # Set up in _startup, since it needs the cache.
+        self._cluster = None
+        self._responder = serialize.JsonResponder(self._config['frontend'])
+        # ETags are the cache generation, which starts over when the frontend does.
+        self._etag_prefix = uuid.uuid4().hex[:12]
 
     async def _startup(self):
         self._event_name = self._config['regfox']['event_name']
-        self._api = regfox.RegFoxClientSession(api_key=self._config['regfox']['api_key'])
+        self._api = regfox.RegFoxClientSession(
+            api_key=self._config['regfox']['api_key'],
+            service_prefix=self._config['regfox'].get('service_prefix', regfox.SERVICE_PREFIX),
+        )
         self._cache = await regfox.RegFoxCache.construct(self._api, self._config['regfox'])
         self._printer = await asyncio.get_event_loop().run_in_executor(None, printegration.Printegration, self._config['printer'])
-        self._update_database_task = asyncio.ensure_future(self._update_database())
+        self._print_queue = printqueue.PrintQueue(self._printer)
+        self._cache.add_listener(self._cache_changed)
+        if self._config['printer'].get('prerender', True):
+            # Its own thread, so warming the cache never holds up a print job waiting on the default pool.
+            self._prerender_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self._cache.add_listener(self._queue_prerender)
+        else:
+            self._prerender_executor = None
+        if self._config['frontend'].get('analytics', True):
+            self._analytics = analytics.RegistrantSnapshot(self._cache, self._cache.start_date)
+            await self._analytics.start()
+        else:
+            self._analytics = None
+        self._cache.start_outbox_drainer(self._config['frontend'].get('checkin_retry_period', 15))
+        if 'cluster' in self._config:
+            # The cluster decides whether this station syncs with RegFox or copies from the one that does.
+            self._cluster = cluster.ClusterNode(self._config, self._cache, self._update_database)
+            await self._cluster.start()
+            self._update_database_task = None
+        else:
+            self._update_database_task = asyncio.ensure_future(self._update_database())
+        self._refresh_printers_task = asyncio.ensure_future(self._refresh_printers())
 
     @classmethod
     async def construct(cls, *arg, **kw):
@@ -37,8 +90,27 @@ class Frontend:
         return self
 
     async def close(self):
-        self._update_database_task.cancel()
+        for queue in self._event_queues:
+            if queue.full():
+                # A browser that's fallen behind won't miss one more message on the way out.
+                queue.get_nowait()
+            queue.put_nowait(None)
+        self._cache.remove_listener(self._cache_changed)
+        if self._cluster is not None:
+            await self._cluster.close()
+        if self._update_database_task is not None:
+            self._update_database_task.cancel()
+        self._refresh_printers_task.cancel()
+        if self._analytics is not None:
+            await self._analytics.close()
+        if self._prerender_executor is not None:
+            self._cache.remove_listener(self._queue_prerender)
+            if self._prerender_task is not None:
+                self._prerender_task.cancel()
+            self._prerender_executor.shutdown(wait=False)
+        await self._print_queue.close()
         await self._cache.close()
+        await self._api.close()
 
     async def __aenter__(self):
         await self._startup()
@@ -49,9 +121,24 @@ class Frontend:
 
     async def _update_database(self):
         while True:
-            await self._cache.sync()
+            try:
+                await self._cache.sync()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Rate limited past the retries, or RegFox is unreachable. The next round picks up from the same mark.
+                print('Unable to sync with RegFox: {}'.format(e))
             await asyncio.sleep(self._config['frontend']['update_period'])
 
+    async def _refresh_printers(self):
+        # Keeps the printer list fresh in the background, so neither printing nor the printer list has to wait on CUPS.
+        loop = asyncio.get_event_loop()
+        period = self._config['printer'].get('printer_refresh_period', 30)
+        while True:
+            try:
+                await loop.run_in_executor(None, self._printer.refresh_printers)
+            except Exception as e:
+                print('Unable to get the printer list from CUPS: {}'.format(e))
+            await asyncio.sleep(period / 2)
+
     def add_routes_to_app(self, app):
         app.add_routes([
             aiohttp.web.StaticDef('/static', 'static', {}),
@@ -60,14 +147,34 @@ class Frontend:
             aiohttp.web.get('/printer_list', self.printer_list),
             aiohttp.web.get('/print_badge', self.print_badge),
             aiohttp.web.get('/print_test', self.print_test),
+            aiohttp.web.get('/print_jobs', self.print_jobs),
             aiohttp.web.get('/update_badge', self.update_badge),
             aiohttp.web.get('/checkin_badge', self.checkin_badge),
             aiohttp.web.get('/checkout_badge', self.checkout_badge),
+            aiohttp.web.get('/checkin_outbox', self.checkin_outbox),
             aiohttp.web.get('/get_api_limits', self.get_api_limits),
             aiohttp.web.get('/get_counts', self.get_counts),
+            aiohttp.web.get('/get_analytics', self.get_analytics),
+            aiohttp.web.get('/events', self.events),
+            aiohttp.web.get('/metrics', self.metrics),
         ])
+        if 'cluster' in self._config:
+            app.add_routes([
+                aiohttp.web.get('/cluster/changes', self.cluster_changes),
+                aiohttp.web.post('/cluster/checkin', self.cluster_checkin),
+                aiohttp.web.post('/cluster/update', self.cluster_update),
+                aiohttp.web.get('/cluster/status', self.cluster_status),
+            ])
+
+    async def _respond(self, request, obj, etag=None):
+        return await self._responder.respond(request, obj, etag)
+
+    def _cache_etag(self, request):
+        # Taken before reading the cache, so a change that lands during the read gets a newer tag, never an older one.
+        return self._responder.check_etag(request, '{}-{}'.format(self._etag_prefix, self._cache.generation))
 
     async def query(self, request):
+        etag = self._cache_etag(request)
         try:
             limit = int(request.query.get('limit', 0))
         except ValueError:
@@ -80,12 +187,21 @@ class Frontend:
 
         criteria = request.query.get('criteria', '')
 
+        if 'after' in request.query:
+            # Paged mode. An empty after asks for the first page.
+            try:
+                after = int(request.query['after'])
+            except ValueError:
+                after = None
+            page = await self._cache.search_registrants_page(criteria, limit or 100, after)
+            return await self._respond(request, page, etag)
+
         registrants = await self._cache.search_registrants(criteria, limit, offset)
-        return aiohttp.web.json_response(registrants, dumps=regfox.JSONEncoder.dumps)
+        return await self._respond(request, registrants, etag)
 
     async def printer_list(self, request):
         printers = await asyncio.get_event_loop().run_in_executor(None, self._printer.printer_list)
-        return aiohttp.web.json_response(printers)
+        return await self._respond(request, printers)
 
     async def print_badge(self, request):
         name = request.query.get('name')
@@ -95,8 +211,8 @@ class Frontend:
         id_ = int(request.query.get('id', 0))
         registrant = await self._cache.get_registrant(id_)
         registrant['eventName'] = self._event_name
-        await asyncio.get_event_loop().run_in_executor(None, self._printer.print_badge, registrant, name)
-        return aiohttp.web.json_response(None)
+        job = await self._print_queue.submit(name, 'badge-{}'.format(id_), self._printer.render_badge, registrant)
+        return await self._respond(request, job.to_dict())
 
     async def print_test(self, request):
         name = request.query.get('name')
@@ -104,32 +220,168 @@ class Frontend:
         if name == "null":
             name = None
 
-        await asyncio.get_event_loop().run_in_executor(None, self._printer.print_test, name, slot)
-        return aiohttp.web.json_response(None)
+        if name is None:
+            name = self._printer.default_printer_name
+        job = await self._print_queue.submit(name, 'testBadge-{}'.format(slot), self._printer.render_test, name, slot)
+        return await self._respond(request, job.to_dict())
+
+    async def print_jobs(self, request):
+        try:
+            job_id = int(request.query['id'])
+        except (KeyError, ValueError):
+            job_id = None
+
+        return await self._respond(request, {
+            'printers': self._print_queue.get_printers(),
+            'jobs': await self._print_queue.get_jobs(job_id),
+        })
 
     async def update_badge(self, request):
         id_ = int(request.query.get('id', 0))
         updated_registrant = await self._cache.update_registrant(id_)
-        return aiohttp.web.json_response(updated_registrant, dumps=regfox.JSONEncoder.dumps)
+        return await self._respond(request, updated_registrant)
 
     async def checkin_badge(self, request):
         id_ = int(request.query.get('id', 0))
         updated_registrant = await self._cache.checkin_registrant(id_)
-        return aiohttp.web.json_response(updated_registrant, dumps=regfox.JSONEncoder.dumps)
+        return await self._respond(request, updated_registrant)
+
+    async def checkin_outbox(self, request):
+        include_sent = request.query.get('all', '') not in ('', '0', 'false')
+        return await self._respond(request, await self._cache.get_outbox(include_sent))
 
     async def checkout_badge(self, request):
         id_ = int(request.query.get('id', 0))
         updated_registrant = await self._cache.checkout_registrant(id_)
-        return aiohttp.web.json_response(updated_registrant, dumps=regfox.JSONEncoder.dumps)
+        return await self._respond(request, updated_registrant)
+
+    # The cluster only exists once the app has started, after the routes were added.
+    async def cluster_changes(self, request):
+        return await self._cluster.changes(request)
+
+    async def cluster_checkin(self, request):
+        return await self._cluster.checkin(request)
+
+    async def cluster_update(self, request):
+        return await self._cluster.update(request)
+
+    async def cluster_status(self, request):
+        return await self._cluster.status(request)
 
     async def main_page(self, request):
         raise aiohttp.web.HTTPFound('/static/index.html')
 
     async def get_api_limits(self, request):
-        return aiohttp.web.json_response(await self._api.get_api_limits(), dumps=regfox.JSONEncoder.dumps)
+        return await self._respond(request, await self._api.get_api_limits())
 
     async def get_counts(self, request):
-        return aiohttp.web.json_response(await self._cache.get_counts(), dumps=regfox.JSONEncoder.dumps)
+        etag = self._cache_etag(request)
+        return await self._respond(request, await self._cache.get_counts(), etag)
+
+    async def get_analytics(self, request):
+        if self._analytics is None:
+            raise aiohttp.web.HTTPNotFound()
+        try:
+            bucket_seconds = max(int(request.query.get('bucket', 900)), 60)
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest()
+        # An empty status counts every registrant, whatever their status.
+        status = request.query.get('status', 'completed') or None
+        # The snapshot catches up with the cache a moment after it changes, so it's tagged with its own generation.
+        etag = self._responder.check_etag(request, '{}-a{}'.format(self._etag_prefix, self._analytics.generation))
+        return await self._respond(request, self._analytics.summary(bucket_seconds, status), etag)
+
+    async def metrics(self, request):
+        # Gauges are only worth filling in when someone asks for them.
+        limits = await self._api.get_api_limits()
+        now = datetime.datetime.utcnow()
+        for window in ('burst', 'daily'):
+            API_QUOTA_REMAINING.set(limits[window]['remaining'], window=window)
+            API_QUOTA_LIMIT.set(limits[window]['limit'], window=window)
+            if limits[window]['reset'] is not None:
+                API_QUOTA_RESET_SECONDS.set(max((limits[window]['reset'] - now).total_seconds(), 0), window=window)
+        API_WAITING.set(limits['waiting'])
+        PRINT_QUEUE_PENDING.clear()
+        for printer_name, printer in self._print_queue.get_printers().items():
+            PRINT_QUEUE_PENDING.set(printer['pending'], printer=printer_name)
+        EVENT_CLIENTS.set(len(self._event_queues))
+        return aiohttp.web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    def _cache_changed(self, event, registrant_ids):
+        if self._event_queues:
+            asyncio.ensure_future(self._broadcast(event, registrant_ids))
+
+    def _queue_prerender(self, event, registrant_ids):
+        if event == 'update':
+            self._prerender_ids.update(registrant_ids)
+        else:
+            self._prerender_all = True
+        if self._prerender_task is None or self._prerender_task.done():
+            self._prerender_task = asyncio.ensure_future(self._prerender())
+
+    async def _prerender(self):
+        # Renders the badges of everyone who might still come to the desk, so print_badge only has to hand
+        # the PNG to CUPS. Stops once the render cache is full, and picks up whatever changed meanwhile.
+        loop = asyncio.get_event_loop()
+        while self._prerender_all or self._prerender_ids:
+            if self._prerender_all:
+                self._prerender_all = False
+                self._prerender_ids.clear()
+                registrants = await self._cache.search_registrants()
+            else:
+                ids, self._prerender_ids = self._prerender_ids, set()
+                registrants = await self._cache.get_registrants(ids)
+
+            for registrant in registrants:
+                if registrant['status'] != 'completed' or registrant['checkedIn']:
+                    continue
+                registrant['eventName'] = self._event_name
+                try:
+                    if not await loop.run_in_executor(self._prerender_executor, self._printer.prerender_badge, registrant):
+                        return
+                except Exception as e:
+                    print('Unable to prerender badge for {}: {}'.format(registrant['registrantId'], e))
+
+    async def _broadcast(self, event, registrant_ids):
+        if event == 'update' and len(registrant_ids) <= self.MAX_EVENT_ROWS:
+            message = ('registrants', self._responder.serializer.dumps(await self._cache.get_registrants(registrant_ids)).decode('utf-8'))
+        else:
+            message = ('reload', 'null')
+
+        for queue in self._event_queues:
+            if queue.full():
+                # This browser has fallen behind. Throw away what it hasn't seen and have it start over.
+                while not queue.empty():
+                    queue.get_nowait()
+                message_for_queue = ('reload', 'null')
+            else:
+                message_for_queue = message
+            queue.put_nowait(message_for_queue)
+
+    async def events(self, request):
+        response = aiohttp.web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        })
+        await response.prepare(request)
+
+        queue = asyncio.Queue(maxsize=50)
+        self._event_queues.add(queue)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), 15)
+                except asyncio.TimeoutError:
+                    await response.write(b': keepalive\n\n')
+                    continue
+                if message is None:
+                    break
+                await response.write('event: {}\ndata: {}\n\n'.format(*message).encode('utf-8'))
+        except ConnectionResetError:
+            pass
+        finally:
+            self._event_queues.discard(queue)
+        return response
 
     async def _app_startup(self, app):
         await self._startup()
@@ -137,14 +389,43 @@ class Frontend:
     async def _app_shutdown(self, app):
         await self.close()
 
+    @aiohttp.web.middleware
+    async def _timing_middleware(self, request, handler):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except aiohttp.web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            # /events streams for as long as the browser stays, so its time means nothing.
+            name = self._handler_name(request)
+            if name != 'events':
+                HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, handler=name, status=status)
+
+    @staticmethod
+    def _handler_name(request):
+        route = request.match_info.route
+        if route.resource is None:
+            return 'unmatched'
+        if isinstance(route.resource, aiohttp.web.StaticResource):
+            return 'static'
+        return getattr(route.handler, '__name__', 'unknown')
+
+    def make_app(self):
+        app = aiohttp.web.Application(middlewares=[self._timing_middleware])
+        self.add_routes_to_app(app)
+        app.on_startup.append(self._app_startup)
+        app.on_shutdown.append(self._app_shutdown)
+        return app
+
     @classmethod
     def run_app(cls, *arg, **kw):
-        app = aiohttp.web.Application()
         frontend = Frontend(*arg, **kw)
-        frontend.add_routes_to_app(app)
-        app.on_startup.append(frontend._app_startup)
-        app.on_shutdown.append(frontend._app_shutdown)
-        aiohttp.web.run_app(app, ssl_context=frontend._ssl, port=frontend._config['frontend']['port'])
+        aiohttp.web.run_app(frontend.make_app(), ssl_context=frontend._ssl, port=frontend._config['frontend']['port'])
 
 
 if __name__ == "__main__":
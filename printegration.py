@@ -1,15 +1,28 @@
 import cups
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import hashlib
 import importlib.util
-import io
 import json
+import metrics
 import os
+import raster
 import sys
+import threading
+import time
 import toml
 import regfox
 import badges
 from TestBadge import TestBadgeTemplate
 
+RENDER_SECONDS = metrics.histogram('badge_render_seconds', 'Time to render and encode one badge.', ('template',))
+CUPS_SUBMIT_SECONDS = metrics.histogram('cups_submit_seconds', 'Time to hand one document to CUPS.', ('printer',))
+RENDER_CACHE_LOOKUPS = metrics.counter('badge_render_cache_lookups', 'Rendered badge cache lookups.', ('result',))
+CUPS_RECONNECTS = metrics.counter('cups_reconnects', 'CUPS connections dropped and reopened after an error.')
+PRINTER_INVENTORY_REFRESHES = metrics.counter('printer_inventory_refreshes', 'Printer lists fetched from CUPS.', ('reason',))
+
+# What libcups reports when cupsd went away (restarted, or isn't up yet) rather than when it refused a request.
+CUPS_CONNECTION_LOST_STATUSES = (cups.IPP_INTERNAL_ERROR, cups.IPP_SERVICE_UNAVAILABLE)
+
 def import_module_file(file_path):
     module_name = os.path.splitext(os.path.basename(file_path))[0]
     spec = importlib.util.spec_from_file_location(module_name, file_path)
@@ -18,16 +31,184 @@ def import_module_file(file_path):
     sys.modules[module_name] = module
     return module
 
+class TemplateRegistry:
+    TemplateEntry = namedtuple("TemplateEntry", ('mtime', 'template'))
+
+    def __init__(self, default_font):
+        self._default_font = default_font
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def template_class_name(template_file):
+        # Given filename ABC.py, the class name should be ABCTemplate
+        return os.path.splitext(os.path.basename(template_file))[0] + "Template"
+
+    def get_entry(self, template_file):
+        mtime = os.stat(template_file).st_mtime_ns
+        with self._lock:
+            entry = self._templates.get(template_file)
+            if entry is None or entry.mtime != mtime:
+                template_module = import_module_file(template_file)
+                template_class = getattr(template_module, self.template_class_name(template_file))
+                entry = self.TemplateEntry(mtime, template_class(default_font=self._default_font))
+                self._templates[template_file] = entry
+            return entry
+
+    def get(self, template_file):
+        return self.get_entry(template_file).template
+
+class FieldRecorder(dict):
+    # Template data that notes which fields the template looked at.
+    def __init__(self, data, fields_read):
+        super().__init__(data)
+        self._fields_read = fields_read
+
+    def __getitem__(self, key):
+        self._fields_read.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self._fields_read.add(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self._fields_read.add(key)
+        return super().__contains__(key)
+
+    def _read_everything(self):
+        self._fields_read.update(super().keys())
+
+    def __iter__(self):
+        self._read_everything()
+        return super().__iter__()
+
+    def keys(self):
+        self._read_everything()
+        return super().keys()
+
+    def values(self):
+        self._read_everything()
+        return super().values()
+
+    def items(self):
+        self._read_everything()
+        return super().items()
+
+class RenderCache:
+    # Rendered badges keyed by template file, its mtime and the values of the fields that template reads, so a
+    # reprint, or a print after the warm-up rendered it, is just a CUPS submit. Least recently used entries go
+    # once the PNGs add up to more than max_bytes.
+    #
+    # Which fields a template reads can depend on the data (SpecialBadge only looks at the age of some badge
+    # levels), so every field any render of the template has read so far goes into the key. A new field
+    # changes every key for that template, which only costs some misses.
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._fields = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(template_key, fields, template_data):
+        values = tuple((field, template_data.get(field)) for field in sorted(fields, key=str))
+        return template_key, hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+    def get(self, template_key, template_data):
+        with self._lock:
+            fields = self._fields.get(template_key)
+            if fields is None:
+                return None
+            key = self._digest(template_key, fields, template_data)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, template_key, template_data, fields_read, entry):
+        with self._lock:
+            fields = self._fields.get(template_key, frozenset()) | frozenset(fields_read)
+            self._fields[template_key] = fields
+            key = self._digest(template_key, fields, template_data)
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self._size += len(entry[0])
+            while self._size > self._max_bytes and self._entries:
+                old_key, old_entry = self._entries.popitem(last=False)
+                self._size -= len(old_entry[0])
+
+    @property
+    def full(self):
+        return self._size >= self._max_bytes
+
+    @property
+    def size(self):
+        return self._size
+
 class Printegration:
     PrinterDef = namedtuple("PrinterDef", ('name', 'info', 'model'))
+    UNKNOWN_PRINTER_REFRESH_SECONDS = 5
     def __init__(self, config):
         self._config = config
-        self._cups_connection = cups.Connection()
+        # cups.Connection isn't thread safe, so every thread that talks to CUPS gets its own, kept for the life of the thread.
+        self._connections = threading.local()
+        self._printers = None
+        self._printers_fetched = 0
+        self._printers_lock = threading.Lock()
+        self._printers_max_age = config.get('printer_refresh_period', 30)
+        self._templates = TemplateRegistry(config['default_font'])
+        self._encoder = raster.BadgeEncoder(config)
+        render_cache_mb = config.get('render_cache_mb', 64)
+        self._render_cache = RenderCache(render_cache_mb * 1024 * 1024) if render_cache_mb else None
+        self._test_template = TestBadgeTemplate(default_font=config['default_font'])
+
+    def _connection(self):
+        connection = getattr(self._connections, 'connection', None)
+        if connection is None:
+            connection = self._connections.connection = cups.Connection()
+        return connection
+
+    @staticmethod
+    def _connection_lost(error):
+        if isinstance(error, cups.IPPError):
+            return error.args[0] in CUPS_CONNECTION_LOST_STATUSES
+        return isinstance(error, (cups.HTTPError, RuntimeError))
+
+    def _cups_call(self, func, retry=True):
+        # Runs func with this thread's connection. If cupsd went away, the connection is thrown out and func
+        # gets one more go on a fresh one (unless it isn't safe to repeat).
+        try:
+            return func(self._connection())
+        except (cups.IPPError, cups.HTTPError, RuntimeError) as e:
+            if not self._connection_lost(e):
+                raise
+            self._connections.connection = None
+            CUPS_RECONNECTS.inc()
+            if not retry:
+                raise
+            print('Lost the connection to CUPS ({}). Reconnecting.'.format(e))
+            return func(self._connection())
+
+    def refresh_printers(self, reason='timer'):
+        printers = self._cups_call(lambda connection: connection.getPrinters())
+        PRINTER_INVENTORY_REFRESHES.inc(reason=reason)
+        with self._printers_lock:
+            self._printers = printers
+            self._printers_fetched = time.monotonic()
+        return printers
+
+    def _printer_inventory(self):
+        with self._printers_lock:
+            printers, fetched = self._printers, self._printers_fetched
+        if printers is None or time.monotonic() - fetched > self._printers_max_age:
+            printers = self.refresh_printers('stale')
+        return printers
 
     def printer_list(self):
-        cups_printer_list = self._cups_connection.getPrinters()
         printer_list = []
-        for printer_name, printer_dict in cups_printer_list.items():
+        for printer_name, printer_dict in self._printer_inventory().items():
             printer_list.append({
                 'printerName': printer_name,
                 'printerInfo': printer_dict['printer-info'],
@@ -35,50 +216,96 @@ class Printegration:
             })
         return printer_list
 
-    def _print_png(self, printer, data, job_name='badge', media=None):
+    def _print_document(self, printer, data, job_name='badge', media=None):
         cups_options = {}
         if media is not None:
             cups_options['media'] = media
+        document_format = self._encoder.document_format or cups.CUPS_FORMAT_AUTO
+
+        def create_job(connection):
+            return connection.createJob(printer, job_name, cups_options)
 
-        job_id = self._cups_connection.createJob(printer, job_name, cups_options)
-        self._cups_connection.startDocument(printer, job_id, job_name, cups.CUPS_FORMAT_AUTO, 1)
-        self._cups_connection.writeRequestData(data, len(data))
-        self._cups_connection.finishDocument(printer)
+        def send_document(connection):
+            connection.startDocument(printer, job_id, job_name, document_format, 1)
+            connection.writeRequestData(data, len(data))
+            connection.finishDocument(printer)
 
-    def _verify_printer_name(self, printer_name):
+        with CUPS_SUBMIT_SECONDS.time(printer=printer):
+            job_id = self._cups_call(create_job)
+            # Once the job exists, sending the document again could print the badge twice.
+            self._cups_call(send_document, retry=False)
+        return job_id
+
+    def verify_printer_name(self, printer_name):
         if printer_name is None:
             printer_name = self._config['printer_name']
-        if printer_name not in self._cups_connection.getPrinters():
-            raise FileNotFoundError("Printer {!r} was not found.".format(printer_name))
+        printers = self._printer_inventory()
+        if printer_name not in printers:
+            # Maybe it was only just added. CUPS is asked again at most every few seconds, however many unknown
+            # names come in.
+            with self._printers_lock:
+                fetched = self._printers_fetched
+            if time.monotonic() - fetched >= self.UNKNOWN_PRINTER_REFRESH_SECONDS:
+                printers = self.refresh_printers('unknown printer')
+            if printer_name not in printers:
+                raise FileNotFoundError("Printer {!r} was not found.".format(printer_name))
         return printer_name
 
+    @property
+    def default_printer_name(self):
+        return self._config['printer_name']
+
+    def submit_document(self, printer_name, data, job_name, media=None):
+        printer_name = self.verify_printer_name(printer_name)
+        return self._print_document(printer_name, data, job_name, media)
+
+    def job_attributes(self, job_id):
+        return self._cups_call(lambda connection: connection.getJobAttributes(job_id, requested_attributes=['job-state', 'job-state-reasons']))
+
+    def render_badge(self, template_data):
+        template_file = self._config['badge_template']
+        mtime, badge_template = self._templates.get_entry(template_file)
+        template_key = (os.path.realpath(template_file), mtime)
+
+        if self._render_cache is not None:
+            cached = self._render_cache.get(template_key, template_data)
+            RENDER_CACHE_LOOKUPS.inc(result='miss' if cached is None else 'hit')
+            if cached is not None:
+                return cached
+
+        fields_read = set()
+        with RENDER_SECONDS.time(template=type(badge_template).__name__):
+            rendered = self.encode_badge(badge_template, FieldRecorder(template_data, fields_read)), badge_template.cups_media
+
+        if self._render_cache is not None:
+            self._render_cache.put(template_key, template_data, fields_read, rendered)
+        return rendered
+
+    def prerender_badge(self, template_data):
+        # Returns False once the render cache is full, since rendering more would only push out other badges.
+        if self._render_cache is None or self._render_cache.full:
+            return False
+        self.render_badge(template_data)
+        return True
+
+    def encode_badge(self, badge_template, template_data):
+        return self._encoder.encode(badge_template.render_image(template_data), badge_template.size, badge_template.dpi)
+
+    def render_test(self, printer_name, printer_slot):
+        with RENDER_SECONDS.time(template=type(self._test_template).__name__):
+            data = self.encode_badge(self._test_template, {'printerSlot': printer_slot, 'printerName': printer_name})
+        return data, self._test_template.cups_media
+
     def print_badge(self, template_data, printer_name=None):
-        printer_name = self._verify_printer_name(printer_name)
-        template_module = import_module_file(self._config['badge_template'])
-        template_class_name = os.path.splitext(os.path.basename(self._config['badge_template']))[0] + "Template"
-        template_class = getattr(template_module, template_class_name)
-        badge_template = template_class(default_font=self._config['default_font'])
-        png_data = io.BytesIO()
-        badge_template.render(template_data, png_data, 'png')
-        self._print_png(
-            printer_name,
-            png_data.getvalue(),
-            'badge-{}'.format(template_data['registrantId']),
-            badge_template.cups_media
-        )
+        printer_name = self.verify_printer_name(printer_name)
+        data, media = self.render_badge(template_data)
+        return self._print_document(printer_name, data, 'badge-{}'.format(template_data['registrantId']), media)
 
     def print_test(self, printer_name, printer_slot):
-        printer_name = self._verify_printer_name(printer_name)
+        printer_name = self.verify_printer_name(printer_name)
         print("Printer: {!r}".format(printer_name))
-        badge_template = TestBadgeTemplate(default_font=self._config['default_font'])
-        png_data = io.BytesIO()
-        badge_template.render({'printerSlot': printer_slot, 'printerName': printer_name}, png_data, 'png')
-        self._print_png(
-            printer_name,
-            png_data.getvalue(),
-            'testBadge-{}'.format(printer_slot),
-            badge_template.cups_media
-        )
+        data, media = self.render_test(printer_name, printer_slot)
+        return self._print_document(printer_name, data, 'testBadge-{}'.format(printer_slot), media)
 
 if __name__ == "__main__":
     import argparse
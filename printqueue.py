@@ -0,0 +1,186 @@
+import asyncio
+import collections
+import concurrent.futures
+import cups
+import itertools
+import time
+
+JOB_QUEUED = 'queued'
+JOB_RENDERING = 'rendering'
+JOB_RENDERED = 'rendered'
+JOB_SENDING = 'sending'
+JOB_SENT = 'sent'
+JOB_FAILED = 'failed'
+
+CUPS_JOB_STATES = {
+    3: 'pending',
+    4: 'held',
+    5: 'processing',
+    6: 'stopped',
+    7: 'canceled',
+    8: 'aborted',
+    9: 'completed',
+}
+
+CUPS_FINAL_JOB_STATES = ('canceled', 'aborted', 'completed')
+
+class PrintJob:
+    def __init__(self, job_id, printer_name, job_name):
+        self.job_id = job_id
+        self.printer_name = printer_name
+        self.job_name = job_name
+        self.state = JOB_QUEUED
+        self.error = None
+        self.cups_job_id = None
+        self.cups_job_state = None
+        self.cups_job_state_reasons = None
+        self.created = time.time()
+        self.sent = None
+        self.rendered = None
+
+    @property
+    def finished(self):
+        return self.state == JOB_FAILED or self.cups_job_state in CUPS_FINAL_JOB_STATES
+
+    def to_dict(self):
+        return {
+            'jobId': self.job_id,
+            'printerName': self.printer_name,
+            'jobName': self.job_name,
+            'state': self.state,
+            'error': self.error,
+            'cupsJobId': self.cups_job_id,
+            'cupsJobState': self.cups_job_state,
+            'cupsJobStateReasons': self.cups_job_state_reasons,
+            'created': self.created,
+            'sent': self.sent,
+        }
+
+class PrinterWorker:
+    # One queue and one thread (so one CUPS connection) per printer, so a jammed printer only holds up its own jobs.
+    def __init__(self, printer, printer_name):
+        self._printer = printer
+        self.printer_name = printer_name
+        self._queue = asyncio.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._task = asyncio.ensure_future(self._run())
+
+    def _submit(self, job, data, media):
+        return self._printer.submit_document(self.printer_name, data, job.job_name, media)
+
+    def put(self, job):
+        self._queue.put_nowait(job)
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            job = await self._queue.get()
+            try:
+                data, media = await job.rendered
+                job.state = JOB_SENDING
+                job.cups_job_id = await loop.run_in_executor(self._executor, self._submit, job, data, media)
+                job.state = JOB_SENT
+                job.sent = time.time()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.state = JOB_FAILED
+                job.error = str(e)
+                print("PRINT FAILED: {} on {!r}: {}".format(job.job_name, self.printer_name, e))
+            finally:
+                job.rendered = None
+
+    async def close(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown(wait=False)
+
+class PrintQueue:
+    def __init__(self, printer, *, history_size=500):
+        self._printer = printer
+        self._history_size = history_size
+        self._workers = {}
+        self._jobs = collections.OrderedDict()
+        self._job_ids = itertools.count(1)
+
+    def _worker(self, printer_name):
+        worker = self._workers.get(printer_name)
+        if worker is None:
+            worker = PrinterWorker(self._printer, printer_name)
+            self._workers[printer_name] = worker
+        return worker
+
+    def _forget_old_jobs(self):
+        while len(self._jobs) > self._history_size:
+            job_id, job = next(iter(self._jobs.items()))
+            if job.rendered is not None:
+                break
+            del self._jobs[job_id]
+
+    async def _render(self, job, render_func, args):
+        job.state = JOB_RENDERING
+        result = await asyncio.get_event_loop().run_in_executor(None, render_func, *args)
+        if job.state == JOB_RENDERING:
+            job.state = JOB_RENDERED
+        return result
+
+    async def submit(self, printer_name, job_name, render_func, *args):
+        # Rendering starts right away on the default executor, so the next badge is being drawn while
+        # the printer's worker is still talking to CUPS about the previous one.
+        if printer_name is None:
+            printer_name = self._printer.default_printer_name
+
+        job = PrintJob(next(self._job_ids), printer_name, job_name)
+        self._jobs[job.job_id] = job
+        self._forget_old_jobs()
+
+        if printer_name not in self._workers:
+            # Only printers CUPS knows about get a worker (and its thread), so a made up name can't leave one behind.
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._printer.verify_printer_name, printer_name)
+            except Exception as e:
+                job.state = JOB_FAILED
+                job.error = str(e)
+                print("PRINT FAILED: {} on {!r}: {}".format(job_name, printer_name, e))
+                return job
+
+        job.rendered = asyncio.ensure_future(self._render(job, render_func, args))
+        self._worker(printer_name).put(job)
+        return job
+
+    async def _refresh(self, job):
+        # On the default executor rather than the printer's worker, so job status never waits behind a stuck submit.
+        if job.cups_job_id is None or job.finished:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            attributes = await loop.run_in_executor(None, self._printer.job_attributes, job.cups_job_id)
+        except (cups.IPPError, cups.HTTPError, RuntimeError) as e:
+            job.error = str(e)
+            return
+        job.cups_job_state = CUPS_JOB_STATES.get(attributes.get('job-state'), attributes.get('job-state'))
+        job.cups_job_state_reasons = attributes.get('job-state-reasons')
+
+    async def get_jobs(self, job_id=None):
+        if job_id is not None:
+            jobs = [self._jobs[job_id]] if job_id in self._jobs else []
+        else:
+            jobs = list(self._jobs.values())
+
+        await asyncio.gather(*[self._refresh(job) for job in jobs])
+        return [job.to_dict() for job in jobs]
+
+    def get_printers(self):
+        return {name: {'pending': worker.pending} for name, worker in self._workers.items()}
+
+    async def close(self):
+        for worker in self._workers.values():
+            await worker.close()
+        self._workers = {}
@@ -0,0 +1,155 @@
+from PIL import Image
+import io
+import re
+import struct
+
+# Encodes rendered badges for CUPS. PNG is what every printer takes, but CUPS then has to sniff it, decode it
+# and dither it before the driver sees a single line. For label printers that print 1-bit anyway, the raster
+# formats below are dithered once here and go straight to the driver's raster filter, and they're smaller too.
+
+FORMAT_PNG = 'png'
+FORMAT_PNG_FAST = 'png-fast'
+FORMAT_PWG_RASTER = 'pwg-raster'
+FORMAT_CUPS_RASTER = 'cups-raster'
+
+DOCUMENT_FORMATS = {
+    FORMAT_PNG: None, # cups.CUPS_FORMAT_AUTO, so CUPS works out what it is.
+    FORMAT_PNG_FAST: None,
+    FORMAT_PWG_RASTER: 'image/pwg-raster',
+    FORMAT_CUPS_RASTER: 'application/vnd.cups-raster',
+}
+
+POINTS_PER_INCH = 72
+
+# Counterclockwise, like PIL.
+ROTATIONS = {0: None, 90: Image.ROTATE_90, 180: Image.ROTATE_180, 270: Image.ROTATE_270}
+
+RASTER_SYNC = b'RaS2'
+RASTER_HEADER_SIZE = 1796
+COLOR_SPACE_K = 3 # CUPS_CSPACE_K: a set bit is black.
+COLOR_SPACE_SGRAY = 18 # PWG's sgray: a set bit is white.
+
+# Every run of one repeated byte, however short.
+_RUNS = re.compile(rb'(.)\1*', re.DOTALL)
+_INVERT = bytes(255 - value for value in range(256))
+
+def to_bitmap(image, dither=True, threshold=128):
+    if image.mode == '1':
+        return image
+    if image.mode != 'L':
+        image = image.convert('L')
+    if dither:
+        return image.convert('1', dither=Image.FLOYDSTEINBERG)
+    return image.point([0] * threshold + [255] * (256 - threshold), '1')
+
+def _compress_line(line, out):
+    # PWG/CUPS v2 run length coding with one byte (eight pixels) per unit. 0-127 repeats the next byte that
+    # many times plus one, 129-255 is followed by 257 minus that many literal bytes.
+    literal = bytearray()
+
+    def flush_literal():
+        for start in range(0, len(literal), 128):
+            chunk = literal[start:start + 128]
+            out.append(0 if len(chunk) == 1 else 257 - len(chunk))
+            out.extend(chunk)
+        del literal[:]
+
+    for match in _RUNS.finditer(line):
+        length = match.end() - match.start()
+        if length == 1:
+            literal += match.group(1)
+            continue
+        flush_literal()
+        while length:
+            count = min(length, 128)
+            out.append(count - 1)
+            out += match.group(1)
+            length -= count
+    flush_literal()
+
+def compress_bitmap(data, bytes_per_line):
+    out = bytearray()
+    lines = [data[start:start + bytes_per_line] for start in range(0, len(data), bytes_per_line)]
+    # Badges are mostly blank margins and the same few strokes, so most lines have been compressed before.
+    compressed = {}
+    index = 0
+    while index < len(lines):
+        # Identical lines that follow are sent once with a repeat count (up to 255 more).
+        line = lines[index]
+        repeat = 0
+        while repeat < 255 and index + repeat + 1 < len(lines) and lines[index + repeat + 1] == line:
+            repeat += 1
+        out.append(repeat)
+        encoded = compressed.get(line)
+        if encoded is None:
+            encoded = compressed[line] = bytearray()
+            _compress_line(line, encoded)
+        out += encoded
+        index += repeat + 1
+    return bytes(out)
+
+def raster_header(width_px, height_px, dpi, size_in, *, pwg):
+    header = bytearray(RASTER_HEADER_SIZE)
+    bytes_per_line = (width_px + 7) // 8
+    page_size = (round(size_in[0] * POINTS_PER_INCH), round(size_in[1] * POINTS_PER_INCH))
+    if pwg:
+        header[0:9] = b'PwgRaster'
+    struct.pack_into('>II', header, 276, dpi, dpi)
+    struct.pack_into('>I', header, 340, 1) # NumCopies
+    struct.pack_into('>II', header, 352, *page_size)
+    struct.pack_into('>II', header, 372, width_px, height_px)
+    struct.pack_into('>III', header, 384, 1, 1, bytes_per_line) # BitsPerColor, BitsPerPixel, BytesPerLine
+    struct.pack_into('>I', header, 400, COLOR_SPACE_SGRAY if pwg else COLOR_SPACE_K)
+    struct.pack_into('>I', header, 420, 1) # NumColors
+    if pwg:
+        struct.pack_into('>I', header, 452, 1) # TotalPageCount
+        name = 'custom_badge_{:g}x{:g}in'.format(*size_in).encode('ascii')
+        header[1732:1732 + len(name)] = name
+    else:
+        struct.pack_into('>fff', header, 424, 1.0, size_in[0] * POINTS_PER_INCH, size_in[1] * POINTS_PER_INCH)
+    return bytes(header)
+
+def encode_raster(bitmap, dpi, size_in, *, pwg):
+    width_px, height_px = bitmap.size
+    data = bitmap.tobytes()
+    if not pwg:
+        data = data.translate(_INVERT)
+    return RASTER_SYNC + raster_header(width_px, height_px, dpi, size_in, pwg=pwg) + compress_bitmap(data, (width_px + 7) // 8)
+
+class BadgeEncoder:
+    def __init__(self, config):
+        self.output_format = config.get('output_format', FORMAT_PNG)
+        if self.output_format not in DOCUMENT_FORMATS:
+            raise ValueError('output_format must be one of {} and not {!r}.'.format(', '.join(DOCUMENT_FORMATS), self.output_format))
+        self._dither = config.get('dither', True)
+        self._threshold = config.get('threshold', 128)
+        self._rotation = config.get('raster_rotation', None)
+
+    @property
+    def document_format(self):
+        return DOCUMENT_FORMATS[self.output_format]
+
+    def _rotation_for(self, size_in):
+        if self._rotation is not None:
+            return self._rotation
+        # Label printers feed labels short edge first, so a landscape badge goes through sideways.
+        return 90 if size_in[0] > size_in[1] else 0
+
+    def encode(self, image, size_in, dpi):
+        if self.output_format in (FORMAT_PNG, FORMAT_PNG_FAST):
+            png_data = io.BytesIO()
+            if self.output_format == FORMAT_PNG_FAST:
+                image.save(png_data, 'png', compress_level=1)
+            else:
+                image.save(png_data, 'png')
+            return png_data.getvalue()
+
+        bitmap = to_bitmap(image, self._dither, self._threshold)
+        rotation = self._rotation_for(size_in) % 360
+        if rotation not in ROTATIONS:
+            raise ValueError('raster_rotation must be 0, 90, 180 or 270 and not {!r}.'.format(rotation))
+        if rotation:
+            bitmap = bitmap.transpose(ROTATIONS[rotation])
+        if rotation in (90, 270):
+            size_in = (size_in[1], size_in[0])
+        return encode_raster(bitmap, int(dpi), size_in, pwg=self.output_format == FORMAT_PWG_RASTER)
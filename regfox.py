@@ -1,14 +1,24 @@
 import asyncio
 import aiohttp
 import aiosqlite
+import collections.abc
 from collections import OrderedDict
+import contextlib
 import pprint
 import datetime
+import functools
+import sqlite3
+import urllib.parse
+import heapq
 import iso8601
+import itertools
 import os
 import sys
+import time
 import toml
 import json
+import metrics
+import re
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -16,16 +26,137 @@ class JSONEncoder(json.JSONEncoder):
             return o.isoformat()
         return super().default(o)
 
+    def iterencode(self, o, _one_shot=False):
+        # Registrants write themselves out, so search results never become dicts on the way to the browser.
+        # Lists and string keyed dicts holding them are walked here; everything else is left to json.
+        if isinstance(o, Registrant):
+            yield o.to_json()
+        elif isinstance(o, list) and any(isinstance(item, Registrant) for item in o):
+            yield '[' + self.item_separator.join([
+                item.to_json() if isinstance(item, Registrant) else ''.join(self.iterencode(item)) for item in o
+            ]) + ']'
+        elif isinstance(o, dict) and all(isinstance(key, str) for key in o) and any(isinstance(value, (Registrant, list)) for value in o.values()):
+            yield '{'
+            for index, (key, value) in enumerate(o.items()):
+                if index:
+                    yield self.item_separator
+                yield _encode_json_string(key) + self.key_separator
+                yield from self.iterencode(value)
+            yield '}'
+        else:
+            yield from super().iterencode(o, _one_shot)
+
     @classmethod
     def dumps(cls, obj, **kw):
         if 'cls' not in kw:
             kw['cls'] = cls
         return json.dumps(obj, **kw)
 
+SERVICE_PREFIX = 'https://api.webconnex.com/v2/public'
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 5
+PRIORITY_BACKGROUND = 10
+
+API_REQUEST_SECONDS = metrics.histogram('regfox_api_request_seconds', 'Time for one RegFox API request, from sending it to parsing the reply.', ('method', 'endpoint', 'status'))
+API_QUEUE_SECONDS = metrics.histogram('regfox_api_queue_seconds', 'Time RegFox API requests wait for the rate limiter.', ('priority',))
+API_PAGES = metrics.counter('regfox_api_pages', 'Result pages fetched from the RegFox API.', ('endpoint',))
+API_RATE_LIMITED = metrics.counter('regfox_api_rate_limited', 'RegFox API requests answered with 429.', ('endpoint',))
+DB_QUERY_SECONDS = metrics.histogram('regfox_cache_query_seconds', 'Time for cache reads, including waiting for a reader connection.', ('query',))
+DB_LOCK_WAIT_SECONDS = metrics.histogram('regfox_cache_lock_wait_seconds', 'Time spent waiting for the cache write lock.', ('operation',))
+DB_LOCK_HELD_SECONDS = metrics.histogram('regfox_cache_lock_held_seconds', 'Time the cache write lock was held.', ('operation',))
+SYNC_ROWS = metrics.counter('regfox_sync_registrants', 'Registrants written by sync.')
+
+OUTBOX_PENDING = 'pending'
+OUTBOX_SENT = 'sent'
+OUTBOX_CONFLICT = 'conflict'
+
+# Token bucket fed by the X-Burst-* and X-Daily-* response headers. Requests wait in priority order (lowest
+# number first) when the budget runs out, and anything above PRIORITY_INTERACTIVE has to leave a reserve
+# behind so background syncs back off before check-ins do.
+class RateLimiter:
+    def __init__(self, *, reserves=None):
+        self._reserves = {'burst': 2, 'daily': 50}
+        if reserves is not None:
+            self._reserves.update(reserves)
+        self._limits = {}
+        self._in_flight = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._timer = None
+
+    def update(self, kind, remaining, reset, limit=None):
+        self._limits[kind] = (remaining, reset, limit)
+        self._wake()
+
+    def _can_run(self, priority):
+        now = time.time()
+        for kind, (remaining, reset, limit) in self._limits.items():
+            if reset is not None and now >= reset:
+                # The window rolled over, so the whole limit is back. Until the next response says otherwise,
+                # that's all that can go out at once.
+                if limit is None:
+                    continue
+                remaining = limit
+            budget = remaining - self._in_flight
+            if priority > PRIORITY_INTERACTIVE:
+                budget -= self._reserves.get(kind, 0)
+            if budget <= 0:
+                return False
+        return True
+
+    def _wake(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._can_run(priority):
+                break
+            heapq.heappop(self._waiters)
+            self._in_flight += 1
+            future.set_result(None)
+
+        if self._waiters:
+            now = time.time()
+            delay = min((reset - now for remaining, reset, limit in self._limits.values() if reset is not None and reset > now), default=1.0)
+            self._timer = asyncio.get_event_loop().call_later(min(max(delay, 0.05), 60.0), self._wake)
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if not self._waiters and self._can_run(priority):
+            self._in_flight += 1
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self._in_flight -= 1
+        self._wake()
+
+    @property
+    def waiting(self):
+        return sum(1 for priority, _, future in self._waiters if not future.done())
+
 class RegFoxClientSession(aiohttp.ClientSession):
-    def __init__(self, *, api_key=None, service_prefix='https://api.webconnex.com/v2/public', **kw):
+    def __init__(self, *, api_key=None, service_prefix=SERVICE_PREFIX, rate_limit_reserves=None, max_retries=5, retry_backoff=1.0, **kw):
         self._service_prefix = service_prefix
         self._api_key = api_key
+        self._rate_limiter = RateLimiter(reserves=rate_limit_reserves)
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._coalesced = {}
 
         self._limit_lock = asyncio.Lock()
         self._burst_limit = 0
@@ -42,23 +173,89 @@ class RegFoxClientSession(aiohttp.ClientSession):
                 kw['headers'] = [('apiKey', str(api_key))]
         super().__init__(**kw)
 
-    async def api_request(self, method, uri, **kw):
-        async with self.request(method, self._service_prefix + uri, **kw) as response:
-            data = await response.json()
+    async def _record_limits(self, headers):
+        if 'X-Burst-Remaining' not in headers or 'X-Daily-Remaining' not in headers:
+            return
 
-            async with self._limit_lock:
-                self._burst_limit = int(response.headers['X-Burst-Limit'])
-                self._burst_remaining = int(response.headers['X-Burst-Remaining'])
-                self._burst_reset = datetime.datetime.utcfromtimestamp(int(response.headers['X-Burst-Limit-Reset']))
-                self._daily_limit = int(response.headers['X-Daily-Limit'])
-                self._daily_remaining = int(response.headers['X-Daily-Remaining'])
-                self._daily_reset = datetime.datetime.utcfromtimestamp(int(response.headers['X-Daily-Limit-Reset']))
+        async with self._limit_lock:
+            self._burst_limit = int(headers['X-Burst-Limit'])
+            self._burst_remaining = int(headers['X-Burst-Remaining'])
+            self._burst_reset = datetime.datetime.utcfromtimestamp(int(headers['X-Burst-Limit-Reset']))
+            self._daily_limit = int(headers['X-Daily-Limit'])
+            self._daily_remaining = int(headers['X-Daily-Remaining'])
+            self._daily_reset = datetime.datetime.utcfromtimestamp(int(headers['X-Daily-Limit-Reset']))
+
+        self._rate_limiter.update('burst', int(headers['X-Burst-Remaining']), int(headers['X-Burst-Limit-Reset']), int(headers['X-Burst-Limit']))
+        self._rate_limiter.update('daily', int(headers['X-Daily-Remaining']), int(headers['X-Daily-Limit-Reset']), int(headers['X-Daily-Limit']))
+
+    def _retry_delay(self, headers, attempt):
+        try:
+            return float(headers['Retry-After'])
+        except (KeyError, ValueError):
+            pass
+        if 'X-Burst-Limit-Reset' in headers:
+            return max(int(headers['X-Burst-Limit-Reset']) - time.time(), self._retry_backoff)
+        return min(self._retry_backoff * 2 ** attempt, 60.0)
 
-            return data
+    @staticmethod
+    def _endpoint(uri):
+        # Ids in the path would make a separate metric for every registrant.
+        return re.sub(r'/\d+', '/{id}', uri)
+
+    async def _scheduled_request(self, method, uri, priority, **kw):
+        endpoint = self._endpoint(uri)
+        for attempt in itertools.count():
+            queued = time.perf_counter()
+            await self._rate_limiter.acquire(priority)
+            start = time.perf_counter()
+            API_QUEUE_SECONDS.observe(start - queued, priority=priority)
+            status = 'error'
+            try:
+                async with self.request(method, self._service_prefix + uri, **kw) as response:
+                    status = response.status
+                    await self._record_limits(response.headers)
+                    if response.status != 429:
+                        return await response.json()
+                    if attempt >= self._max_retries:
+                        # A 429 body isn't an answer, and callers would take it for one.
+                        API_RATE_LIMITED.inc(endpoint=endpoint)
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status,
+                            message='Still rate limited after {} retries'.format(attempt), headers=response.headers)
+                    delay = self._retry_delay(response.headers, attempt)
+            finally:
+                self._rate_limiter.release()
+                API_REQUEST_SECONDS.observe(time.perf_counter() - start, method=method, endpoint=endpoint, status=status)
+            API_RATE_LIMITED.inc(endpoint=endpoint)
+            print("RATE LIMITED: {} {}, retrying in {:.1f}s".format(method, uri, delay))
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _forget_coalesced(coalesced, key):
+        def done_callback(future):
+            if coalesced.get(key) is future:
+                del coalesced[key]
+            if not future.cancelled():
+                future.exception()
+        return done_callback
+
+    async def api_request(self, method, uri, *, priority=PRIORITY_NORMAL, **kw):
+        if method != 'GET' or priority <= PRIORITY_INTERACTIVE or set(kw) - {'params'}:
+            return await self._scheduled_request(method, uri, priority, **kw)
+
+        # Identical low priority reads that are already queued or in flight share one request.
+        key = (uri, tuple(sorted((kw.get('params') or {}).items())))
+        pending = self._coalesced.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._scheduled_request(method, uri, priority, **kw))
+            self._coalesced[key] = pending
+            pending.add_done_callback(self._forget_coalesced(self._coalesced, key))
+        return await asyncio.shield(pending)
 
     async def get_api_limits(self):
         async with self._limit_lock:
             return {
+                    'waiting': self._rate_limiter.waiting,
                     'burst': {
                         'limit': self._burst_limit,
                         'remaining': self._burst_remaining,
@@ -71,17 +268,30 @@ class RegFoxClientSession(aiohttp.ClientSession):
                     }
             }
 
-    async def api_get(self, uri, **params):
+    async def api_iter(self, uri, *, priority=PRIORITY_NORMAL, **params):
+        # Yields one page at a time. The request for the next page is sent before the current one is handed
+        # to the caller, so whatever the caller does with a page overlaps with fetching the next.
+        next_page = asyncio.ensure_future(self.api_request('GET', uri, priority=priority, params=dict(params)))
+        try:
+            while next_page is not None:
+                new_data = await next_page
+                next_page = None
+                API_PAGES.inc(endpoint=self._endpoint(uri))
+                if isinstance(new_data['data'], list) and new_data.get('hasMore', False):
+                    params['startingAfter'] = new_data['startingAfter']
+                    next_page = asyncio.ensure_future(self.api_request('GET', uri, priority=priority, params=dict(params)))
+                yield new_data['data']
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def api_get(self, uri, *, priority=PRIORITY_NORMAL, **params):
         data_list = []
 
-        while True:
-            new_data = await self.api_request('GET', uri, params=params)
-            if not isinstance(new_data['data'], list):
-                return new_data['data']
-            data_list += new_data['data']
-            if not new_data.get('hasMore', False):
-                break
-            params['startingAfter'] = new_data['startingAfter']
+        async for data in self.api_iter(uri, priority=priority, **params):
+            if not isinstance(data, list):
+                return data
+            data_list += data
         return data_list
 
     async def search_transactions(self, id_=None, **params):
@@ -102,6 +312,12 @@ class RegFoxClientSession(aiohttp.ClientSession):
             uri += '/{}'.format(id_)
         return await self.api_get(uri, **params)
 
+    def iter_registrants(self, *, priority=PRIORITY_BACKGROUND, **params):
+        return self.api_iter('/search/registrants', priority=priority, **params)
+
+    def iter_orders(self, *, priority=PRIORITY_BACKGROUND, **params):
+        return self.api_iter('/search/orders', priority=priority, **params)
+
     async def search_customers(self, id_=None, **params):
         uri = '/search/customers'
         if id_ is not None:
@@ -133,27 +349,54 @@ class RegFoxClientSession(aiohttp.ClientSession):
         uri = '/coupons/{}'.format(id_)
         return await self.api_get(uri, **params)
 
-    async def check_in(self, **params):
-        return await self.api_request('POST', '/registrant/check-in', **params)
+    async def check_in(self, *, priority=PRIORITY_INTERACTIVE, **params):
+        return await self.api_request('POST', '/registrant/check-in', priority=priority, **params)
 
-    async def check_out(self, **params):
-        return await self.api_request('POST', '/registrant/check-out', **params)
+    async def check_out(self, *, priority=PRIORITY_INTERACTIVE, **params):
+        return await self.api_request('POST', '/registrant/check-out', priority=priority, **params)
 
 class RegFoxCache:
+    SEARCH_COLUMNS = ('firstName', 'lastName', 'email', 'attendeeBadgeName', 'phone', 'displayId')
+    # More orders missing than this and it's cheaper to page through all of them than to ask for each by id.
+    ORDER_LOOKUP_LIMIT = 100
+    # Orders looked up by id at once.
+    ORDER_LOOKUP_BATCH = 10
+
     def __init__(self, client_session, config):
         self._client_session = client_session
         self._db_file = config['database_file']
         self._db = None
+        self._readers = None
+        self._reader_count = config.get('reader_connections', 4)
+        self._closed = False
+        self._pragmas = {
+            'synchronous': config.get('synchronous', 'full'),
+            # Negative cache_size is in KiB.
+            'cache_size': -int(config.get('cache_size_kb', 16384)),
+            'mmap_size': int(config.get('mmap_size_mb', 256)) * 1024 * 1024,
+        }
         self._form_id = str(config['form_id'])
         self._db_lock = asyncio.Lock()
+        self._sync_lock = asyncio.Lock()
         self._start_date = self.date_from_regfox(config['start_date'])
+        self._fts = False
+        self._listeners = []
+        self._outbox_wakeup = asyncio.Event()
+        self._outbox_task = None
+        self._outbox_sender = None
+        self._registrant_updater = None
+        self._badge_columns = None
+        self._cache_counts = config.get('cache_counts', True)
+        self._counts = None
+        self._counts_generation = 0
+        self._registrant_layouts = {}
+        self._generation = 0
 
     async def _startup(self):
         self._first_sync = self._db_file == ':memory:' or not os.path.exists(self._db_file)
 
-        async with self._db_lock:
-            self._db = await aiosqlite.connect(self._db_file)
-            self._db.row_factory = aiosqlite.Row
+        async with self._write_lock('startup'):
+            self._db = await self._connect()
             await self._db.execute('''
                 create table if not exists badges (
                     registrantId INT PRIMARY KEY,
@@ -173,7 +416,137 @@ class RegFoxCache:
                     dateCheckedIn INT
                 )
             ''')
+            await self._db.execute('''
+                create table if not exists sync_state (
+                    formId TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    lastUpdated INT NOT NULL,
+                    PRIMARY KEY (formId, kind)
+                )
+            ''')
+            await self._db.execute('''
+                create table if not exists orders (
+                    orderId INT PRIMARY KEY,
+                    billingCountry TEXT,
+                    billingZip TEXT,
+                    dateUpdated INT
+                )
+            ''')
+            await self._db.execute('''
+                create table if not exists checkin_outbox (
+                    registrantId INT PRIMARY KEY,
+                    dateCheckedIn INT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INT NOT NULL DEFAULT 0,
+                    lastError TEXT,
+                    dateQueued INT NOT NULL,
+                    dateSent INT
+                )
+            ''')
+            await self._db.execute('create index if not exists badges_email on badges (email collate nocase)')
+            await self._db.execute('create index if not exists badges_counts on badges (status, checkedIn, badgeLevel)')
+            await self._db.execute('create index if not exists badges_order on badges (orderId)')
+            self._fts = await self._create_search_index()
             await self._db.commit()
+            async with self._db.execute('pragma table_info(badges)') as cursor:
+                self._badge_columns = [row[1] for row in await cursor.fetchall()]
+
+            if self._reader_count:
+                self._readers = asyncio.Queue()
+                for reader in range(self._reader_count):
+                    self._readers.put_nowait(await self._connect(read_only=True))
+
+    def _database_uri(self, read_only):
+        if self._db_file == ':memory:':
+            # A named shared cache database, so the readers see the same tables as the writer. It lives until
+            # the last connection to it closes.
+            return 'file:regfox-{}-{}?mode=memory&cache=shared'.format(os.getpid(), id(self))
+        uri = 'file:{}'.format(urllib.parse.quote(os.path.abspath(self._db_file)))
+        if read_only:
+            uri += '?mode=ro'
+        return uri
+
+    async def _connect(self, read_only=False):
+        # One connection writes. The rest only read, so searches and counts don't queue up behind a sync on the
+        # writer's thread. With WAL they read the last committed state while the writer keeps going.
+        db = await aiosqlite.connect(self._database_uri(read_only), uri=True)
+        db.row_factory = aiosqlite.Row
+        if self._db_file == ':memory:':
+            if read_only:
+                # Shared cache locks whole tables. Without this a reader would get "database table is locked"
+                # for as long as a sync transaction is open, at the price of seeing rows that aren't committed yet.
+                await db.execute('pragma read_uncommitted=1')
+        elif not read_only:
+            await db.execute('pragma journal_mode=wal')
+            await db.execute('pragma synchronous={}'.format(self._pragmas['synchronous']))
+        if read_only:
+            await db.execute('pragma query_only=1')
+        await db.execute('pragma cache_size={:d}'.format(self._pragmas['cache_size']))
+        await db.execute('pragma mmap_size={:d}'.format(self._pragmas['mmap_size']))
+        return db
+
+    async def _read(self, sql, params=(), query='other'):
+        if self._closed:
+            raise sqlite3.ProgrammingError('The cache is closed.')
+        start = time.perf_counter()
+        readers = self._readers
+        if readers is None:
+            db = self._db
+        else:
+            db = await readers.get()
+        try:
+            async with db.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+        finally:
+            if readers is not None:
+                readers.put_nowait(db)
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, query=query)
+
+    @contextlib.asynccontextmanager
+    async def _write_lock(self, operation):
+        start = time.perf_counter()
+        async with self._db_lock:
+            locked = time.perf_counter()
+            DB_LOCK_WAIT_SECONDS.observe(locked - start, operation=operation)
+            try:
+                yield
+            finally:
+                DB_LOCK_HELD_SECONDS.observe(time.perf_counter() - locked, operation=operation)
+
+    async def _create_search_index(self):
+        columns = ', '.join(self.SEARCH_COLUMNS)
+        old_columns = ', '.join('old.{}'.format(column) for column in self.SEARCH_COLUMNS)
+        new_columns = ', '.join('new.{}'.format(column) for column in self.SEARCH_COLUMNS)
+
+        async with self._db.execute("select 1 from sqlite_master where type='table' and name='badges_fts'") as cursor:
+            index_exists = await cursor.fetchone() is not None
+
+        try:
+            await self._db.execute("create virtual table if not exists badges_fts using fts5({}, content='badges', content_rowid='registrantId')".format(columns))
+        except sqlite3.OperationalError as e:
+            print("FTS5 UNAVAILABLE, USING LIKE SEARCH:", e)
+            return False
+
+        await self._db.execute('''
+            create trigger if not exists badges_fts_insert after insert on badges begin
+                insert into badges_fts (rowid, {0}) values (new.registrantId, {1});
+            end
+        '''.format(columns, new_columns))
+        await self._db.execute('''
+            create trigger if not exists badges_fts_delete after delete on badges begin
+                insert into badges_fts (badges_fts, rowid, {0}) values ('delete', old.registrantId, {1});
+            end
+        '''.format(columns, old_columns))
+        await self._db.execute('''
+            create trigger if not exists badges_fts_update after update of registrantId, {0} on badges begin
+                insert into badges_fts (badges_fts, rowid, {0}) values ('delete', old.registrantId, {1});
+                insert into badges_fts (rowid, {0}) values (new.registrantId, {2});
+            end
+        '''.format(columns, old_columns, new_columns))
+
+        if not index_exists:
+            await self._db.execute("insert into badges_fts (badges_fts) values ('rebuild')")
+        return True
 
     @classmethod
     async def construct(cls, *args, **kwargs):
@@ -182,7 +555,20 @@ class RegFoxCache:
         return self
 
     async def close(self):
-        async with self._db_lock:
+        if self._outbox_task is not None:
+            self._outbox_task.cancel()
+            try:
+                await self._outbox_task
+            except asyncio.CancelledError:
+                pass
+            self._outbox_task = None
+        self._closed = True
+        async with self._write_lock('close'):
+            if self._readers is not None:
+                # Reads already under way hand their connection back before it's closed.
+                for reader in range(self._reader_count):
+                    await (await self._readers.get()).close()
+                self._readers = None
             await self._db.close()
 
     async def __aenter__(self):
@@ -192,6 +578,28 @@ class RegFoxCache:
     async def __aexit__(self, exc_type, exc, tb):
         await self.close()
 
+    @property
+    def start_date(self):
+        return self._start_date
+
+    def add_listener(self, callback):
+        # callback(event, registrant_ids) is called after every committed change. event is 'update' with the
+        # registrantIds that changed, or 'reload' when the whole table was replaced.
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    @property
+    def generation(self):
+        # Goes up with every committed change, so anything read from the cache can be tagged with it.
+        return self._generation
+
+    def _notify(self, event, registrant_ids=None):
+        self._generation += 1
+        for listener in list(self._listeners):
+            listener(event, registrant_ids)
+
     @staticmethod
     def list_to_dict(lst, id_field='id'):
         retval = {}
@@ -235,6 +643,10 @@ class RegFoxCache:
             return None
         return datetime.datetime.utcfromtimestamp(database_date)
 
+    @staticmethod
+    def datetime_database_to_regfox(database_date):
+        return datetime.datetime.utcfromtimestamp(database_date).isoformat() + 'Z'
+
     @staticmethod
     def calculate_age(dob, now=datetime.date.today()):
         if not dob or now < dob:
@@ -278,7 +690,7 @@ class RegFoxCache:
 
         return fields, field_labels
 
-    def _regfox_to_database(self, registrant, fields=None, order_dict=None):
+    def _regfox_to_database(self, registrant, fields=None):
         if fields is None:
             fields = self._parse_options(registrant)[0]
         values = OrderedDict()
@@ -293,89 +705,448 @@ class RegFoxCache:
         values['attendeeBadgeName'] = fields.get('attendeeBadgeName', None)
         values['dateOfBirth'] = self.date_to_database(self.date_from_regfox(fields.get('dateOfBirth', None)))
         values['phone'] = fields.get('phone', None)
-        if order_dict is not None:
-            values['billingCountry'] = order_dict[registrant['orderId']]['billing']['address'].get('country', None)
-            values['billingZip'] = order_dict[registrant['orderId']]['billing']['address'].get('postalCode', None)
         values['checkedIn'] = registrant['checkedIn']
         values['dateCheckedIn'] = self.datetime_to_database(self.datetime_from_regfox(registrant.get('dateCheckedIn', None)))
         return values
 
+    async def _get_sync_mark(self, kind):
+        async with self._db.execute('select lastUpdated from sync_state where formId=? and kind=?', [self._form_id, kind]) as cursor:
+            row = await cursor.fetchone()
+            return None if row is None else row[0]
+
+    async def _set_sync_mark(self, kind, last_updated):
+        await self._db.execute(
+            'insert into sync_state (formId, kind, lastUpdated) values (?, ?, ?) '
+            'on conflict(formId, kind) do update set lastUpdated=max(lastUpdated, excluded.lastUpdated)',
+            [self._form_id, kind, last_updated])
+
+    def _max_date_updated(self, items, last_updated=None):
+        for item in items:
+            item_updated = self.datetime_to_database(self.datetime_from_regfox(item.get('dateUpdated', item.get('dateCreated', None))))
+            if item_updated is not None and (last_updated is None or item_updated > last_updated):
+                last_updated = item_updated
+        return last_updated
+
+    async def _join_billing(self, column, ids):
+        # Copies the billing address from orders into the badges matching ids, whichever of the two arrived first.
+        # Returns the registrantIds whose address changed.
+        ids = list(ids)
+        changed = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ', '.join(['?'] * len(chunk))
+            async with self._db.execute('''
+                select badges.registrantId from badges join orders on orders.orderId=badges.orderId
+                where badges.{} in ({}) and (badges.billingCountry is not orders.billingCountry or badges.billingZip is not orders.billingZip)
+            '''.format(column, placeholders), chunk) as cursor:
+                changed += [row[0] for row in await cursor.fetchall()]
+            await self._db.execute('''
+                update badges set (billingCountry, billingZip) = (
+                    select billingCountry, billingZip from orders where orders.orderId=badges.orderId
+                ) where {} in ({}) and orderId in (select orderId from orders)
+            '''.format(column, placeholders), chunk)
+        return changed
+
+    async def _store_orders(self, orders):
+        # Returns the registrantIds whose billing address changed.
+        rows = []
+        for order in orders:
+            address = (order.get('billing') or {}).get('address') or {}
+            date_updated = self.datetime_to_database(self.datetime_from_regfox(order.get('dateUpdated', order.get('dateCreated', None))))
+            rows.append([order['id'], address.get('country', None), address.get('postalCode', None), date_updated])
+        if not rows:
+            return []
+        await self._db.executemany(
+            'insert into orders (orderId, billingCountry, billingZip, dateUpdated) values (?, ?, ?, ?) '
+            'on conflict(orderId) do update set billingCountry=excluded.billingCountry, '
+            'billingZip=excluded.billingZip, dateUpdated=excluded.dateUpdated', rows)
+        return await self._join_billing('orderId', [row[0] for row in rows])
+
+    async def _sync_orders(self, order_params):
+        # Writes each page of orders as it arrives. Returns the newest dateUpdated seen.
+        order_mark = None
+        async for orders in self._client_session.iter_orders(formId=self._form_id, **order_params):
+            async with self._write_lock('sync'):
+                changed = await self._store_orders(orders)
+                await self._db.commit()
+            if changed:
+                # Only the addresses changed, but anything tagged with the old generation is out of date.
+                self._notify('update', changed)
+            order_mark = self._max_date_updated(orders, order_mark)
+        return order_mark
+
+    async def _fetch_order(self, order_id, priority=PRIORITY_BACKGROUND):
+        response = await self._client_session.api_request('GET', '/search/orders/{}'.format(order_id), priority=priority)
+        if response.get('responseCode') == 404:
+            # Remembered without an address, so it isn't asked for again every sync. update_registrant retries it.
+            return {'id': order_id}
+        if response.get('responseCode') != 200 or not response.get('data'):
+            # Anything else (a server error, say) says nothing about the order. It's asked for again later.
+            raise aiohttp.ClientError('RegFox answered {} for order {}: {}'.format(response.get('responseCode'), order_id, response.get('message', '')))
+        return response['data']
+
+    async def _fetch_registrant(self, registrant_id, priority):
+        # None if RegFox doesn't have them (any more).
+        response = await self._client_session.api_request('GET', '/search/registrants/{}'.format(registrant_id), priority=priority)
+        if response.get('responseCode') == 404:
+            return None
+        if response.get('responseCode') != 200:
+            raise aiohttp.ClientError('RegFox answered {} for registrant {}: {}'.format(response.get('responseCode'), registrant_id, response.get('message', '')))
+        return response.get('data') or None
+
+    async def _missing_order_ids(self):
+        async with self._db.execute('select distinct orderId from badges where orderId not in (select orderId from orders)') as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def _seed_orders(self):
+        # Billing already on the badges (in a cache from before the orders table, or in rows copied from a cluster
+        # leader) stands in for the orders it came from, instead of fetching all of them again.
+        await self._db.execute('''
+            insert or ignore into orders (orderId, billingCountry, billingZip)
+            select orderId, billingCountry, billingZip from badges
+            where (billingCountry is not null or billingZip is not null) and orderId not in (select orderId from orders)
+            group by orderId
+        ''')
+
+    async def _fetch_missing_orders(self):
+        # Only fetches orders some badge refers to that we've never seen. Returns the newest dateUpdated paged
+        # through, if it came to that.
+        order_mark = None
+        async with self._write_lock('sync'):
+            await self._seed_orders()
+            await self._db.commit()
+            missing = await self._missing_order_ids()
+        if len(missing) > self.ORDER_LOOKUP_LIMIT:
+            # Page through every order. Missing ones can be old, so only looking at recent changes would leave
+            # most of them to be asked for one by one.
+            order_mark = await self._sync_orders({})
+            async with self._write_lock('sync'):
+                missing = await self._missing_order_ids()
+
+        # Whatever is left (orders that aren't listed for the form) is asked for by id.
+        for start in range(0, len(missing), self.ORDER_LOOKUP_BATCH):
+            batch = missing[start:start + self.ORDER_LOOKUP_BATCH]
+            orders = []
+            for order_id, order in zip(batch, await asyncio.gather(*[self._fetch_order(order_id) for order_id in batch], return_exceptions=True)):
+                if isinstance(order, (aiohttp.ClientError, asyncio.TimeoutError)):
+                    # Still missing, so the next sync asks again.
+                    print("ORDER LOOKUP FAILED: {}: {}".format(order_id, order))
+                elif isinstance(order, BaseException):
+                    raise order
+                else:
+                    orders.append(order)
+            async with self._write_lock('sync'):
+                changed = await self._store_orders(orders)
+                await self._db.commit()
+            if changed:
+                # Only the addresses changed, but anything tagged with the old generation is out of date.
+                self._notify('update', changed)
+        return order_mark
+
+    @staticmethod
+    def _upsert_sql(columns):
+        updates = []
+        for column in columns:
+            if column == 'registrantId':
+                continue
+            updates.append('{0}=excluded.{0}'.format(column))
+        return 'insert into badges ({}) values ({}) on conflict(registrantId) do update set {}'.format(
+            ', '.join(columns),
+            ', '.join(['?'] * len(columns)),
+            ', '.join(updates)
+        )
+
     async def sync(self, *, rebuild=False):
-        async with self._db_lock:
+        # Pages are fetched without holding the write lock, which is only taken to write and commit each one.
+        # A check-in never waits on RegFox for longer than it takes to write a page.
+        async with self._sync_lock:
             registrant_params = {}
-            order_params = {}
-            if rebuild or self._first_sync:
+            full_sync = rebuild or self._first_sync
+            if full_sync:
                 self._first_sync = False
                 print("REBUILD:", registrant_params)
             else:
-                async with self._db.execute('select max(registrantId), max(orderId) from badges') as cursor:
-                    (max_registrant_id, max_order_id) = await cursor.fetchone()
-                    if max_registrant_id is not None:
-                        registrant_params['greaterThanId'] = str(max_registrant_id)
-                    if max_order_id is not None:
-                        order_params['greaterThanId'] = str(max_order_id)
-
-            registrants, orders = await asyncio.gather(
-                self._client_session.search_registrants(formId=self._form_id, **registrant_params),
-                self._client_session.search_orders(formId=self._form_id, **order_params),
-            )
-            inserts = []
-            columns = None
-            order_dict = self.list_to_dict(orders)
-
-            for registrant in registrants:
-                values = self._regfox_to_database(registrant, None, order_dict)
-                if columns is None:
-                    columns = list(values.keys())
-                inserts.append(list(values.values()))
-
-            print("ADDED:", len(inserts))
-
-            if rebuild:
-                await self._db.execute('delete from badges')
-
-            if inserts:
-                insert_columns = ', '.join(columns)
-                insert_placeholders = ', '.join(['?'] * len(columns))
-                await self._db.executemany('insert into badges ({}) values ({})'.format(insert_columns, insert_placeholders), inserts)
-
+                # Ask for everything modified since the newest change we've seen. Back off by a second since
+                # dateUpdated only has one second resolution; the upsert makes the overlap harmless.
+                registrant_mark = await self._get_sync_mark('registrants')
+                if registrant_mark is not None:
+                    registrant_params['dateUpdatedAfter'] = self.datetime_database_to_regfox(registrant_mark - 1)
+
+            # Orders are paged alongside the registrants, writing both as they come: every order on a full sync,
+            # and after that the ones changed since the last. Billing is joined in from the orders table whichever
+            # side arrives first. Orders some badge refers to that still haven't turned up are fetched afterwards.
+            order_params = None
+            if full_sync:
+                order_params = {}
+            else:
+                order_mark = await self._get_sync_mark('orders')
+                if order_mark is not None:
+                    order_params = {'dateUpdatedAfter': self.datetime_database_to_regfox(order_mark - 1)}
+            orders_task = asyncio.ensure_future(self._sync_orders(order_params)) if order_params is not None else None
+            pages = self._client_session.iter_registrants(formId=self._form_id, **registrant_params)
+            upsert_sql = None
+            updated_ids = []
+            registrant_mark = None
+            order_mark = None
+
+            try:
+                # Each page is written while the next one is still on the wire. A sync that fails part way leaves
+                # the pages it wrote, and the next one starts over from the same mark.
+                async for registrants in pages:
+                    inserts = []
+                    for registrant in registrants:
+                        values = self._regfox_to_database(registrant)
+                        if upsert_sql is None:
+                            upsert_sql = self._upsert_sql(list(values.keys()))
+                        inserts.append(list(values.values()))
+
+                    page_ids = [registrant['id'] for registrant in registrants]
+                    if inserts:
+                        async with self._write_lock('sync'):
+                            await self._db.executemany(upsert_sql, inserts)
+                            await self._join_billing('registrantId', page_ids)
+                            await self._reapply_pending_checkins()
+                            await self._db.commit()
+                        self._invalidate_counts()
+                        self._notify('update', page_ids)
+                    updated_ids += page_ids
+                    SYNC_ROWS.inc(len(registrants))
+                    registrant_mark = self._max_date_updated(registrants, registrant_mark)
+
+                if orders_task is not None:
+                    order_mark = await orders_task
+                missing_mark = await self._fetch_missing_orders()
+                if missing_mark is not None and (order_mark is None or missing_mark > order_mark):
+                    order_mark = missing_mark
+            except BaseException:
+                if orders_task is not None:
+                    orders_task.cancel()
+                    await asyncio.gather(orders_task, return_exceptions=True)
+                raise
+            finally:
+                await pages.aclose()
+
+            print("UPDATED:", len(updated_ids))
+
+            async with self._write_lock('sync'):
+                if rebuild:
+                    # Rows RegFox no longer lists. They're only dropped now, so the table is never empty mid-sync.
+                    await self._delete_registrants_except(updated_ids)
+                if registrant_mark is not None:
+                    await self._set_sync_mark('registrants', registrant_mark)
+                if order_mark is not None:
+                    await self._set_sync_mark('orders', order_mark)
+                await self._db.commit()
+
+        self._invalidate_counts()
+        if self._cache_counts:
+            await self._load_counts()
+
+        if rebuild:
+            self._notify('reload')
+
+    async def _delete_registrants_except(self, keep_ids):
+        keep_ids = set(keep_ids)
+        async with self._db.execute('select registrantId from badges') as cursor:
+            gone = [row[0] for row in await cursor.fetchall() if row[0] not in keep_ids]
+        for start in range(0, len(gone), 500):
+            chunk = gone[start:start + 500]
+            await self._db.execute('delete from badges where registrantId in ({})'.format(', '.join(['?'] * len(chunk))), chunk)
+
+    async def get_sync_marks(self):
+        rows = await self._read('select kind, lastUpdated from sync_state where formId=?', [self._form_id], 'sync_marks')
+        return {row['kind']: row['lastUpdated'] for row in rows}
+
+    async def get_rows(self, ids=None):
+        # Rows as they're stored, for copying into another cache with apply_rows.
+        if ids is None:
+            return [dict(row) for row in await self._read('select * from badges order by registrantId', query='rows')]
+        rows = []
+        ids = list(ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            sql = 'select * from badges where registrantId in ({})'.format(', '.join(['?'] * len(chunk)))
+            rows += [dict(row) for row in await self._read(sql, chunk, 'rows')]
+        return rows
+
+    async def apply_rows(self, rows, *, replace=False, marks=None):
+        # Writes rows from get_rows on another cache, instead of asking RegFox. replace throws away every row
+        # that isn't among them. marks are that cache's sync marks, so a sync from here later picks up where it left off.
+        columns = [column for column in rows[0] if column in self._badge_columns] if rows else []
+        updated_ids = [row['registrantId'] for row in rows]
+        async with self._write_lock('apply'):
+            try:
+                if replace:
+                    await self._db.execute('delete from badges')
+                if rows:
+                    await self._db.executemany(self._upsert_sql(columns), [[row[column] for column in columns] for row in rows])
+                for kind, last_updated in (marks or {}).items():
+                    await self._set_sync_mark(kind, last_updated)
+                    self._first_sync = False
+                await self._reapply_pending_checkins()
+            except BaseException:
+                await self._db.rollback()
+                raise
             await self._db.commit()
 
-    def registrant_row_to_dict(self, reg):
-        reg_dict = dict(reg)
-        self.pythonify_row(reg_dict)
-        return reg_dict
+        self._invalidate_counts()
+        if self._cache_counts:
+            await self._load_counts()
 
-    async def search_registrants(self, criteria='', limit=0, offset=0):
-        search_columns = ('firstName', 'lastName', 'email', 'attendeeBadgeName', 'phone', 'displayId')
+        if replace:
+            self._notify('reload')
+        elif updated_ids:
+            self._notify('update', updated_ids)
 
-        sql = 'select * from badges where '
-        sql += ' or '.join(['{} like ?'.format(column) for column in search_columns])
+    def _registrant_layout(self, row):
+        columns = tuple(row.keys())
+        layout = self._registrant_layouts.get(columns)
+        if layout is None:
+            layout = self._registrant_layouts[columns] = RegistrantLayout(columns, self._start_date)
+        return layout
+
+    def registrant_from_row(self, row):
+        return Registrant(row, self._registrant_layout(row))
+
+    @staticmethod
+    def _limit_clause(limit, offset):
+        sql = ''
         if limit:
             sql += ' limit {:d}'.format(limit)
             if offset:
                 sql += ' offset {:d}'.format(offset)
+        return sql
 
-        async with self._db.execute(sql, ["%{}%".format(criteria)] * len(search_columns)) as cursor:
-            registrants = await cursor.fetchall()
-            if not registrants:
-                return []
-            returning = []
-            for reg in registrants:
-                returning.append(self.registrant_row_to_dict(reg))
-            return returning
+    @staticmethod
+    def _fts_query(criteria):
+        # Every whitespace separated term has to match the start of a token somewhere in the row.
+        return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in criteria.split())
+
+    async def _fetch_registrants(self, sql, params):
+        rows = await self._read(sql, params, 'registrants')
+        if not rows:
+            return []
+        # Every row of one query has the same columns.
+        layout = self._registrant_layout(rows[0])
+        return [Registrant(row, layout) for row in rows]
+
+    async def _like_search_registrants(self, criteria, limit, offset):
+        where, params = self._like_condition(criteria)
+        return await self._fetch_registrants('select * from badges where ' + where + self._limit_clause(limit, offset), params)
+
+    async def search_registrants(self, criteria='', limit=0, offset=0):
+        criteria = criteria.strip()
+        if not criteria:
+            return await self._fetch_registrants('select * from badges' + self._limit_clause(limit, offset), [])
+
+        if not self._fts:
+            return await self._like_search_registrants(criteria, limit, offset)
+
+        # Scanning a badge or typing in a whole email address should hit an index and nothing else. Checked on
+        # every page, so later pages of an exact hit come from the same rows as the first.
+        exact_sql = 'select * from badges where displayId=? union select * from badges where email=? collate nocase'
+        if await self._read('select 1 from ({}) limit 1'.format(exact_sql), [criteria, criteria], 'exact'):
+            return await self._fetch_registrants(
+                'select * from ({}) order by registrantId'.format(exact_sql) + self._limit_clause(limit, offset),
+                [criteria, criteria])
+
+        sql = 'select badges.* from badges_fts join badges on badges.registrantId = badges_fts.rowid '
+        sql += 'where badges_fts match ? order by bm25(badges_fts)'
+        sql += self._limit_clause(limit, offset)
+        try:
+            return await self._fetch_registrants(sql, [self._fts_query(criteria)])
+        except sqlite3.DatabaseError:
+            # A query FTS5 can't parse, or (in a :memory: cache, whose readers see uncommitted rows) an index
+            # caught half way through a sync write.
+            return await self._like_search_registrants(criteria, limit, offset)
+
+    def _like_condition(self, criteria):
+        return ' or '.join(['{} like ?'.format(column) for column in self.SEARCH_COLUMNS]), ["%{}%".format(criteria)] * len(self.SEARCH_COLUMNS)
+
+    async def _count_registrants(self, where, params):
+        return (await self._read('select count(1) from badges where {}'.format(where), params, 'count'))[0][0]
+
+    async def _search_condition(self, criteria):
+        # Returns a where clause, and its parameters, selecting the rows search_registrants would find.
+        if not criteria:
+            return '1', []
+
+        if not self._fts:
+            return self._like_condition(criteria)
+
+        exact_ids = [row[0] for row in await self._read('select registrantId from badges where displayId=? union select registrantId from badges where email=? collate nocase', [criteria, criteria], 'exact')]
+        if exact_ids:
+            return 'registrantId in ({})'.format(', '.join(['?'] * len(exact_ids))), exact_ids
+
+        return 'registrantId in (select rowid from badges_fts where badges_fts match ?)', [self._fts_query(criteria)]
+
+    async def _search_page(self, where, params, limit, after):
+        total = await self._count_registrants(where, params)
+        sql = 'select * from badges where ({})'.format(where)
+        page_params = list(params)
+        if after is not None:
+            sql += ' and registrantId > ?'
+            page_params.append(after)
+        # One extra row tells us whether there's another page without a second query.
+        sql += ' order by registrantId' + self._limit_clause(limit + 1 if limit else None, 0)
+        return total, await self._fetch_registrants(sql, page_params)
+
+    async def search_registrants_page(self, criteria='', limit=100, after=None):
+        # Keyset pagination on registrantId: the page after a given row stays the same no matter how many
+        # rows sync adds in the meantime, and no rows are skipped over the way offset would.
+        criteria = criteria.strip()
+        where, params = await self._search_condition(criteria)
+
+        try:
+            total, registrants = await self._search_page(where, params, limit, after)
+        except sqlite3.DatabaseError:
+            # As in search_registrants.
+            where, params = self._like_condition(criteria)
+            total, registrants = await self._search_page(where, params, limit, after)
+
+        next_after = None
+        if limit and len(registrants) > limit:
+            registrants = registrants[:limit]
+            next_after = registrants[-1]['registrantId']
+        return {
+            'registrants': registrants,
+            'total': total,
+            'next': next_after,
+        }
+
+    async def get_registrants(self, ids):
+        returning = []
+        ids = list(ids)
+        # Stay well under SQLITE_MAX_VARIABLE_NUMBER.
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            sql = 'select * from badges where registrantId in ({})'.format(', '.join(['?'] * len(chunk)))
+            returning += await self._fetch_registrants(sql, chunk)
+        return returning
 
     async def get_registrant(self, id_):
-        async with self._db.execute('select * from badges where registrantId = ?', [id_]) as cursor:
-            if cursor.rowcount == 0:
-                return False
-            if cursor.rowcount > 1:
-                raise RuntimeError('Registrant {} found multiple times. (This should be impossible since that column is the primary key.)'.format(id_))
-            return self.registrant_row_to_dict(await cursor.fetchone())
+        rows = await self._read('select * from badges where registrantId = ?', [id_], 'get_registrant')
+        if not rows:
+            return False
+        if len(rows) > 1:
+            raise RuntimeError('Registrant {} found multiple times. (This should be impossible since that column is the primary key.)'.format(id_))
+        return self.registrant_from_row(rows[0])
+
+    def set_registrant_updater(self, updater):
+        # await updater(registrant_id) gets a registrant's current row (as get_rows gives it, or None) from
+        # somewhere other than RegFox. Cluster followers ask the leader. None asks RegFox.
+        self._registrant_updater = updater
 
     async def update_registrant(self, id_):
-        async with self._db_lock:
-            registrant = await self._client_session.search_registrants(id_)
+        if self._registrant_updater is not None:
+            row = await self._registrant_updater(id_)
+            if not row:
+                return False
+            await self.apply_rows([row])
+            return await self.get_registrant(id_)
+
+        async with self._write_lock('update_registrant'):
+            registrant = await self._fetch_registrant(id_, PRIORITY_INTERACTIVE)
             if not registrant:
                 return False
 
@@ -390,7 +1161,24 @@ class RegFoxCache:
                 if cursor.rowcount > 1:
                     raise RuntimeError('Somehow multiple rows were updated. This should be impossible. Rolling back transaction...')
 
+            # Syncs never look at an order again once it's stored, so this is where a changed billing address comes in.
+            changed = []
+            if registrant.get('orderId') is not None:
+                try:
+                    order = await self._fetch_order(registrant['orderId'], PRIORITY_INTERACTIVE)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # The registrant is still worth updating. The address the badge has stays.
+                    print("ORDER LOOKUP FAILED: {}: {}".format(registrant['orderId'], e))
+                    order = None
+                if order is not None and len(order) > 1:
+                    # Also picks up the other registrants on the same order.
+                    changed = await self._store_orders([order])
+                else:
+                    await self._join_billing('registrantId', [id_])
+
             await self._db.commit()
+        self._invalidate_counts()
+        self._notify('update', [id_] + [other for other in changed if other != id_])
         return await self.get_registrant(id_)
 
     def _make_checkin_data_dict(self, id_, time=None):
@@ -410,13 +1198,13 @@ class RegFoxCache:
 
         return data
 
-    async def checkin_registrant(self, id_, time=None):
+    async def _checkin_remote(self, id_, time=None):
         check_in_data = await self._client_session.check_in(json=self._make_checkin_data_dict(id_, time))
 
         if check_in_data['responseCode'] != 200:
             return False
 
-        async with self._db_lock:
+        async with self._write_lock('checkin'):
             await self._db.execute(
                 '''update badges set dateCheckedIn=?, checkedIn=? where registrantId=?''',
                 (
@@ -425,44 +1213,376 @@ class RegFoxCache:
                     check_in_data['data']['id']
                 ))
             await self._db.commit()
+        self._invalidate_counts()
+        self._notify('update', [check_in_data['data']['id']])
 
-        return await self.get_registrant(id_)
+        return await self.get_registrant(check_in_data['data']['id'])
+
+    async def checkin_registrant(self, id_, time=None):
+        # The check-in is recorded locally and queued in checkin_outbox, so the badge can print right away even
+        # when the uplink is down. The outbox drainer sends it to RegFox afterwards.
+        column = 'registrantId' if isinstance(id_, int) else 'displayId'
+        rows = await self._read('select registrantId, checkedIn, status, badgeLevel from badges where {}=?'.format(column), [id_], 'checkin')
+        row = rows[0] if rows else None
+        if row is None:
+            if self._registrant_updater is not None:
+                # Whoever keeps this cache up to date hasn't sent them yet, and only they talk to RegFox.
+                return False
+            # Not in the cache yet, so there's nothing to check against. Ask RegFox directly.
+            return await self._checkin_remote(id_, time)
+
+        registrant_id = row['registrantId']
+        if row['checkedIn']:
+            # Already checked in, whether here or at the desk next door. Don't queue it twice.
+            return await self.get_registrant(registrant_id)
+        if row['status'] != 'completed':
+            # RegFox only checks in completed registrations. Queueing anyone else would print a badge that the
+            # outbox takes back later.
+            return False
+
+        if time is None:
+            checked_in = datetime.datetime.now(datetime.timezone.utc)
+        else:
+            checked_in = time.replace(tzinfo=datetime.timezone.utc)
+        date_checked_in = self.datetime_to_database(checked_in)
+
+        async with self._write_lock('checkin'):
+            await self._db.execute('update badges set checkedIn=1, dateCheckedIn=? where registrantId=?', [date_checked_in, registrant_id])
+            await self._db.execute(
+                'insert into checkin_outbox (registrantId, dateCheckedIn, state, dateQueued) values (?, ?, ?, ?) '
+                'on conflict(registrantId) do update set dateCheckedIn=excluded.dateCheckedIn, state=excluded.state, '
+                'attempts=0, lastError=null, dateQueued=excluded.dateQueued, dateSent=null',
+                [registrant_id, date_checked_in, OUTBOX_PENDING, date_checked_in])
+            await self._db.commit()
+        self._count_checkin(row['badgeLevel'])
+        self._notify('update', [registrant_id])
+        self._outbox_wakeup.set()
+
+        return await self.get_registrant(registrant_id)
+
+    async def _reapply_pending_checkins(self):
+        # Check-ins RegFox hasn't heard about yet would otherwise be undone by the rows sync just wrote.
+        await self._db.execute('''
+            update badges set checkedIn=1, dateCheckedIn=(
+                select dateCheckedIn from checkin_outbox where checkin_outbox.registrantId=badges.registrantId
+            ) where checkedIn=0 and registrantId in (select registrantId from checkin_outbox where state=?)
+        ''', [OUTBOX_PENDING])
+
+    async def _set_outbox_state(self, registrant_id, state, error=None):
+        async with self._write_lock('outbox'):
+            await self._db.execute(
+                'update checkin_outbox set state=?, attempts=attempts+1, lastError=?, dateSent=? where registrantId=? and state=?',
+                [state, error, int(time.time()) if state == OUTBOX_SENT else None, registrant_id, OUTBOX_PENDING])
+            await self._db.commit()
 
-    async def _get_badge_type_counts(self, where='', type_column='badgeLevel'):
-        async with self._db.execute('select {0} as badgeLevel, COUNT({0}) as badgeLevelCount from badges {1} group by {0}'.format(type_column, where)) as cursor:
-            badge_levels = {}
-            rows = await cursor.fetchall()
-            for row in rows:
-                badge_levels[row['badgeLevel']] = row['badgeLevelCount']
-            return badge_levels
+    def set_outbox_sender(self, sender):
+        # await sender(registrant_id, date_checked_in) delivers queued check-ins somewhere other than RegFox and
+        # returns (state, error) like _send_checkin. Cluster followers hand theirs to the leader. None sends to RegFox.
+        self._outbox_sender = sender
+        self._outbox_wakeup.set()
+
+    async def _send_checkin(self, registrant_id, date_checked_in):
+        if self._outbox_sender is not None:
+            return await self._outbox_sender(registrant_id, date_checked_in)
+
+        check_in_data = await self._client_session.check_in(priority=PRIORITY_NORMAL, json={
+            'id': registrant_id,
+            'date': self.datetime_database_to_regfox(date_checked_in),
+        })
+        response_code = check_in_data.get('responseCode')
+        if response_code == 200:
+            return OUTBOX_SENT, None
+        if not isinstance(response_code, int) or not 400 <= response_code < 500 or response_code == 429:
+            # Rate limited or a server error isn't an answer about this check-in. It stays pending like it
+            # would if RegFox couldn't be reached at all.
+            raise aiohttp.ClientError('RegFox answered {}: {}'.format(response_code, check_in_data.get('message', '')))
+
+        # An earlier attempt may have gone through even though we never saw the answer. If RegFox already
+        # has them checked in, that's the result we wanted.
+        registrant = await self._fetch_registrant(registrant_id, PRIORITY_NORMAL)
+        if registrant and registrant.get('checkedIn'):
+            return OUTBOX_SENT, None
+        return OUTBOX_CONFLICT, str(check_in_data.get('message', response_code))
+
+    async def drain_outbox(self):
+        # Returns True if everything pending was delivered or rejected, False if RegFox couldn't be reached or
+        # some check-in couldn't be sent.
+        pending = await self._read('select registrantId, dateCheckedIn from checkin_outbox where state=? order by dateQueued', [OUTBOX_PENDING], 'outbox')
+
+        conflicts = []
+        delivered = True
+        for row in pending:
+            try:
+                state, error = await self._send_checkin(row['registrantId'], row['dateCheckedIn'])
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                print("CHECK-IN OUTBOX: RegFox unreachable, {} check-ins waiting: {}".format(len(pending), e))
+                await self._record_outbox_error(row['registrantId'], e)
+                return False
+            except Exception as e:
+                # Something about this check-in in particular. It stays pending, but doesn't hold up the ones behind it.
+                print("CHECK-IN OUTBOX: unable to send {}: {}".format(row['registrantId'], e))
+                await self._record_outbox_error(row['registrantId'], e)
+                delivered = False
+                continue
+
+            await self._set_outbox_state(row['registrantId'], state, error)
+            if state == OUTBOX_CONFLICT:
+                print("CHECK-IN CONFLICT: {}: {}".format(row['registrantId'], error))
+                conflicts.append(row['registrantId'])
+
+        if conflicts:
+            # Pull RegFox's side of the story (through the leader, on a cluster follower) so every station shows
+            # what actually happened.
+            for registrant_id in conflicts:
+                try:
+                    await self.update_registrant(registrant_id)
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                    print("CHECK-IN CONFLICT: unable to update {}: {}".format(registrant_id, e))
+        return delivered
+
+    async def _record_outbox_error(self, registrant_id, error):
+        async with self._write_lock('outbox'):
+            await self._db.execute('update checkin_outbox set attempts=attempts+1, lastError=? where registrantId=?', [str(error), registrant_id])
+            await self._db.commit()
+
+    async def _drain_outbox_forever(self, retry_period):
+        delay = retry_period
+        while True:
+            try:
+                await asyncio.wait_for(self._outbox_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._outbox_wakeup.clear()
+            try:
+                delivered = await self.drain_outbox()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("CHECK-IN OUTBOX FAILED:", e)
+                delivered = False
+            # Back off while the uplink is down, but keep trying.
+            delay = retry_period if delivered else min(delay * 2, retry_period * 16)
+
+    def start_outbox_drainer(self, retry_period=15):
+        if self._outbox_task is None:
+            self._outbox_task = asyncio.ensure_future(self._drain_outbox_forever(retry_period))
+            self._outbox_wakeup.set()
+
+    async def get_outbox(self, include_sent=False):
+        sql = 'select * from checkin_outbox'
+        params = []
+        if not include_sent:
+            sql += ' where state!=?'
+            params.append(OUTBOX_SENT)
+        sql += ' order by dateQueued'
+        rows = await self._read(sql, params, 'outbox')
+        outbox = []
+        for row in rows:
+            entry = dict(row)
+            for column in ('dateCheckedIn', 'dateQueued', 'dateSent'):
+                entry[column] = self.datetime_from_database(entry[column])
+            outbox.append(entry)
+        return outbox
+
+    def _invalidate_counts(self):
+        self._counts = None
+        self._counts_generation += 1
+
+    def _count_checkin(self, badge_level):
+        # Bumping the generation throws away any recount that started before this check-in was committed.
+        self._counts_generation += 1
+        if self._counts is not None:
+            self._counts.setdefault(badge_level, [0, 0])[1] += 1
+
+    async def _load_counts(self):
+        # One pass over the badges_counts index instead of a query per number.
+        generation = self._counts_generation
+        rows = await self._read('''
+            select badgeLevel, count(1) as total, sum(checkedIn) as checkedIn
+            from badges where status='completed' group by badgeLevel
+        ''', query='counts')
+        counts = {row['badgeLevel']: [row['total'], row['checkedIn']] for row in rows}
+        if self._cache_counts and generation == self._counts_generation:
+            self._counts = counts
+        return counts
 
     async def get_counts(self):
-        async with self._db_lock:
-            output = {}
-            async with self._db.execute('select count(1) from badges where status="completed"') as cursor:
-                output['total'] = (await cursor.fetchone())[0]
-            async with self._db.execute('select count(1) from badges where status="completed" and checkedIn=1') as cursor:
-                output['checked_in'] = (await cursor.fetchone())[0]
-            output['total_badge_counts'] = await self._get_badge_type_counts('where status="completed"')
-            output['checked_in_badge_counts'] = await self._get_badge_type_counts('where status="completed" and checkedIn=1')
-            output['checked_out_badge_counts'] = await self._get_badge_type_counts('where status="completed" and checkedIn=0')
-            return output
+        # With cache_counts on this is answered from memory and never waits on a sync.
+        counts = self._counts
+        if counts is None:
+            counts = await self._load_counts()
+
+        output = {
+            'total': 0,
+            'checked_in': 0,
+            'total_badge_counts': {},
+            'checked_in_badge_counts': {},
+            'checked_out_badge_counts': {},
+        }
+        for badge_level, (total, checked_in) in counts.items():
+            output['total'] += total
+            output['checked_in'] += checked_in
+            output['total_badge_counts'][badge_level] = total
+            if checked_in:
+                output['checked_in_badge_counts'][badge_level] = checked_in
+            if total - checked_in:
+                output['checked_out_badge_counts'][badge_level] = total - checked_in
+        return output
 
     async def checkout_registrant(self, id_, time=None):
         # This endpoint appears to not be functional at this time.
         #return await self._client_session.check_out(json=self._make_checkin_data_dict(id_, time))
         return False
 
+_encode_json_string = json.encoder.encode_basestring_ascii
+
+def _json_value(value):
+    # The same text json.dumps(value, cls=JSONEncoder) gives, for the types a registrant holds.
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    value_type = type(value)
+    if value_type is int:
+        return int.__repr__(value)
+    if value_type is str:
+        return _encode_json_string(value)
+    if value_type in (datetime.date, datetime.datetime):
+        return '"{}"'.format(value.isoformat())
+    return JSONEncoder.dumps(value)
+
+def _json_text(value):
+    return _encode_json_string(value) if value.__class__ is str else _json_value(value)
+
+# Birthdays repeat a lot, so their JSON is worked out once each.
+@functools.lru_cache(maxsize=65536)
+def _json_date_of_birth(value):
+    return _json_value(RegFoxCache.date_from_database(value))
+
+def _json_checked_in(value):
+    return 'true' if value else 'false'
+
+def _json_date_checked_in(value):
+    return 'null' if value is None else _json_value(RegFoxCache.datetime_from_database(value))
+
+class RegistrantLayout:
+    # What every Registrant from one query shares: where each column is in the row, how to convert it for
+    # callers and for JSON, and the JSON object with the values left out.
+    CONVERTERS = {
+        'dateOfBirth': (RegFoxCache.date_from_database, _json_date_of_birth),
+        'checkedIn': (bool, _json_checked_in),
+        'dateCheckedIn': (RegFoxCache.datetime_from_database, _json_date_checked_in),
+    }
+    AGES = ('ageAtEvent', 'ageNow')
+
+    def __init__(self, columns, start_date):
+        self.columns = columns
+        self.index = {column: position for position, column in enumerate(columns)}
+        self.converters = [self.CONVERTERS.get(column, (None, None))[0] for column in columns]
+        self.json_converters = [self.CONVERTERS.get(column, (None, _json_text))[1] for column in columns]
+        self.keys = columns
+        self.date_of_birth = self.index.get('dateOfBirth')
+        if self.date_of_birth is not None:
+            self.keys += self.AGES
+        self.key_set = frozenset(self.keys)
+        self.json_template = '{' + ', '.join('{}: %s'.format(_encode_json_string(key)) for key in self.keys) + '}'
+        self.start_date = start_date
+        self._ages = {}
+
+    def ages(self, date_of_birth):
+        # (ageAtEvent, ageNow) for a stored dateOfBirth.
+        ages = self._ages.get(date_of_birth)
+        if ages is None:
+            birthday = RegFoxCache.date_from_database(date_of_birth)
+            ages = self._ages[date_of_birth] = (RegFoxCache.calculate_age(birthday, self.start_date), RegFoxCache.calculate_age(birthday))
+        return ages
+
+class Registrant(collections.abc.MutableMapping):
+    # One row of badges, read like the dict RegFoxCache used to return for it. Only the row from SQLite is
+    # kept: dates, checkedIn and the ages are converted when they're asked for, and to_json writes the JSON
+    # from the row directly. Keys set afterwards (eventName, for printing) are kept alongside and win over the row.
+    __slots__ = ('_row', '_layout', '_extra')
+
+    def __init__(self, row, layout):
+        self._row = row
+        self._layout = layout
+        self._extra = None
+
+    def __getitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        layout = self._layout
+        position = layout.index.get(key)
+        if position is not None:
+            value = self._row[position]
+            convert = layout.converters[position]
+            return value if convert is None or value is None else convert(value)
+        if key in layout.AGES and layout.date_of_birth is not None:
+            return layout.ages(self._row[layout.date_of_birth])[layout.AGES.index(key)]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __delitem__(self, key):
+        if self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __contains__(self, key):
+        return key in self._layout.key_set or (self._extra is not None and key in self._extra)
+
+    def __iter__(self):
+        yield from self._layout.keys
+        if self._extra is not None:
+            for key in self._extra:
+                if key not in self._layout.key_set:
+                    yield key
+
+    def __len__(self):
+        return len(self._layout.keys) + sum(1 for key in self._extra or () if key not in self._layout.key_set)
+
+    def __repr__(self):
+        return 'Registrant({!r})'.format(self.to_dict())
+
+    def to_dict(self):
+        # dict(registrant) works too, one key at a time. This is quicker.
+        layout = self._layout
+        row = self._row
+        values = {
+            column: value if convert is None or value is None else convert(value)
+            for column, convert, value in zip(layout.columns, layout.converters, row)
+        }
+        if layout.date_of_birth is not None:
+            values['ageAtEvent'], values['ageNow'] = layout.ages(row[layout.date_of_birth])
+        if self._extra is not None:
+            values.update(self._extra)
+        return values
+
+    def to_json(self):
+        if self._extra is not None:
+            return '{' + ', '.join([_encode_json_string(key) + ': ' + _json_value(self[key]) for key in self]) + '}'
+        layout = self._layout
+        row = self._row
+        values = [json_converter(value) for json_converter, value in zip(layout.json_converters, row)]
+        if layout.date_of_birth is not None:
+            values.extend(layout.ages(row[layout.date_of_birth]))
+        return layout.json_template % tuple(values)
+
 async def display_form_ids(config_file):
     config = toml.load(config_file)
-    async with RegFoxClientSession(api_key=config['regfox']['api_key']) as api:
+    async with RegFoxClientSession(api_key=config['regfox']['api_key'], service_prefix=config['regfox'].get('service_prefix', SERVICE_PREFIX)) as api:
         form_data = [{'id': 'Form ID', 'name': 'Form Name'}] + await api.forms()
         for datum in form_data:
             print('{id:7}   {name}'.format(**datum))
 
 async def search_registrants(config_file, criteria):
     config = toml.load(config_file)
-    async with RegFoxClientSession(api_key=config['regfox']['api_key']) as api:
+    async with RegFoxClientSession(api_key=config['regfox']['api_key'], service_prefix=config['regfox'].get('service_prefix', SERVICE_PREFIX)) as api:
         async with RegFoxCache(api, config['regfox']) as cache:
             await cache.sync()
             registrants = await cache.search_registrants(criteria)
@@ -471,35 +1591,37 @@ async def search_registrants(config_file, criteria):
 
 async def get_registrant(config_file, id_):
     config = toml.load(config_file)
-    async with RegFoxClientSession(api_key=config['regfox']['api_key']) as api:
+    async with RegFoxClientSession(api_key=config['regfox']['api_key'], service_prefix=config['regfox'].get('service_prefix', SERVICE_PREFIX)) as api:
         async with RegFoxCache(api, config['regfox']) as cache:
             await cache.sync()
             pprint.pprint(await cache.get_registrant(id_))
 
 async def update_registrant(config_file, id_):
     config = toml.load(config_file)
-    async with RegFoxClientSession(api_key=config['regfox']['api_key']) as api:
+    async with RegFoxClientSession(api_key=config['regfox']['api_key'], service_prefix=config['regfox'].get('service_prefix', SERVICE_PREFIX)) as api:
         async with RegFoxCache(api, config['regfox']) as cache:
             await cache.sync()
             pprint.pprint(await cache.update_registrant(id_))
 
 async def check_in(config_file, id_):
     config = toml.load(config_file)
-    async with RegFoxClientSession(api_key=config['regfox']['api_key']) as api:
+    async with RegFoxClientSession(api_key=config['regfox']['api_key'], service_prefix=config['regfox'].get('service_prefix', SERVICE_PREFIX)) as api:
         async with RegFoxCache(api, config['regfox']) as cache:
             await cache.sync()
             pprint.pprint(await cache.checkin_registrant(id_))
+            if not await cache.drain_outbox():
+                print('RegFox could not be reached. The check-in is saved locally and will be sent the next time the outbox is drained.')
 
 async def check_out(config_file, id_):
     config = toml.load(config_file)
-    async with RegFoxClientSession(api_key=config['regfox']['api_key']) as api:
+    async with RegFoxClientSession(api_key=config['regfox']['api_key'], service_prefix=config['regfox'].get('service_prefix', SERVICE_PREFIX)) as api:
         async with RegFoxCache(api, config['regfox']) as cache:
             await cache.sync()
             pprint.pprint(await cache.checkout_registrant(id_))
 
 async def main(config_file):
     config = toml.load(config_file)
-    async with RegFoxClientSession(api_key=config['regfox']['api_key']) as api:
+    async with RegFoxClientSession(api_key=config['regfox']['api_key'], service_prefix=config['regfox'].get('service_prefix', SERVICE_PREFIX)) as api:
         async with RegFoxCache(api, config['regfox']) as cache:
             await cache.sync(rebuild=False)
 
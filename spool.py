@@ -0,0 +1,155 @@
+from collections import namedtuple
+import csv
+import io
+import os
+import zlib
+
+POINTS_PER_INCH = 72.0
+
+# Spools take pages as they're rendered and write them straight out, so a run of thousands of badges never
+# holds more than one page in memory. encode_page() is a staticmethod so the expensive part can run in a
+# render worker process and only the encoded bytes come back to the process that owns the file.
+
+PdfPage = namedtuple('PdfPage', ('width', 'height', 'color_space', 'bits', 'data'))
+
+class PdfSpool:
+    def __init__(self, file_name):
+        self._file = open(file_name, 'wb')
+        self._position = 0
+        self._offsets = {}
+        self._page_ids = []
+        # Objects 1 and 2 are the catalog and page tree. They're written last, once every page is known.
+        self._next_id = 3
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @staticmethod
+    def encode_page(image):
+        if image.mode == '1':
+            color_space, bits = b'/DeviceGray', 1
+        elif image.mode in ('L', 'LA'):
+            image = image.convert('L')
+            color_space, bits = b'/DeviceGray', 8
+        else:
+            image = image.convert('RGB')
+            color_space, bits = b'/DeviceRGB', 8
+        return PdfPage(image.width, image.height, color_space, bits, zlib.compress(image.tobytes(), 6))
+
+    def _write(self, data):
+        self._file.write(data)
+        self._position += len(data)
+
+    def _allocate(self):
+        obj_id = self._next_id
+        self._next_id += 1
+        return obj_id
+
+    def _write_object(self, obj_id, body, stream=None):
+        self._offsets[obj_id] = self._position
+        self._write(b'%d 0 obj\n' % obj_id)
+        self._write(body)
+        if stream is not None:
+            self._write(b'\nstream\n')
+            self._write(stream)
+            self._write(b'\nendstream')
+        self._write(b'\nendobj\n')
+
+    def add_page(self, page, size_in, name=None, media=None):
+        width_pt = size_in[0] * POINTS_PER_INCH
+        height_pt = size_in[1] * POINTS_PER_INCH
+
+        image_id = self._allocate()
+        self._write_object(image_id, b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent %d /Filter /FlateDecode /Length %d >>' % (
+            page.width, page.height, page.color_space, page.bits, len(page.data)), page.data)
+
+        contents = b'q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q' % (width_pt, height_pt)
+        contents_id = self._allocate()
+        self._write_object(contents_id, b'<< /Length %d >>' % len(contents), contents)
+
+        page_id = self._allocate()
+        self._write_object(page_id, b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>' % (
+            width_pt, height_pt, image_id, contents_id))
+        self._page_ids.append(page_id)
+
+    def add_image(self, image, size_in, name=None, media=None):
+        self.add_page(self.encode_page(image), size_in, name, media)
+
+    def close(self):
+        if self._file is None:
+            return
+
+        kids = b' '.join(b'%d 0 R' % page_id for page_id in self._page_ids)
+        self._write_object(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self._page_ids)))
+        self._write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+        xref_position = self._position
+        self._write(b'xref\n0 %d\n' % self._next_id)
+        self._write(b'0000000000 65535 f \n')
+        for obj_id in range(1, self._next_id):
+            self._write(b'%010d 00000 n \n' % self._offsets[obj_id])
+        self._write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (self._next_id, xref_position))
+
+        self._file.close()
+        self._file = None
+
+    @property
+    def page_count(self):
+        return len(self._page_ids)
+
+class PngSpool:
+    MANIFEST_NAME = 'manifest.csv'
+    MANIFEST_FIELDS = ('page', 'file', 'name', 'media', 'widthInches', 'heightInches')
+
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, self.MANIFEST_NAME)
+        self._page_count = 0
+        new_manifest = not os.path.exists(manifest_path)
+        if not new_manifest:
+            # Picking up where an earlier run left off.
+            with open(manifest_path, 'r', newline='') as manifest:
+                self._page_count = max(sum(1 for row in csv.reader(manifest)) - 1, 0)
+        self._manifest = open(manifest_path, 'a', newline='')
+        self._writer = csv.writer(self._manifest)
+        if new_manifest:
+            self._writer.writerow(self.MANIFEST_FIELDS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @staticmethod
+    def encode_page(image):
+        png_data = io.BytesIO()
+        image.save(png_data, 'png')
+        return png_data.getvalue()
+
+    def add_page(self, page, size_in, name=None, media=None):
+        self._page_count += 1
+        if name is None:
+            name = 'page-{:05d}'.format(self._page_count)
+        file_name = '{}.png'.format(name)
+        with open(os.path.join(self._directory, file_name), 'wb') as png_file:
+            png_file.write(page)
+        self._writer.writerow((self._page_count, file_name, name, media, size_in[0], size_in[1]))
+        self._manifest.flush()
+
+    def add_image(self, image, size_in, name=None, media=None):
+        self.add_page(self.encode_page(image), size_in, name, media)
+
+    def close(self):
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+
+    @property
+    def page_count(self):
+        return self._page_count
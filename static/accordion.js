@@ -157,6 +157,17 @@ function accordion_replace_item(root_elem, id, new_title_elem, new_data_elem, ne
 	_accordion_set_item_state(new_title_elem, new_data_elem, root_elem, old_elem_state);
 }
 
+/**
+ * Count the items in an accordion element.
+ *
+ * @param root_elem The jQuery element that has had accordion_make() called on it.
+ * @returns the number of title elements.
+ */
+function accordion_count_items(root_elem)
+{
+	return root_elem.children(".ac_title,dt").length;
+}
+
 /**
  * Get the current state of the given item.
  *
@@ -25,6 +25,19 @@ function render_registrant(entry)
 	return row;
 }
 
+function replace_entry(entry)
+{
+	if(!accordion_get_title_elem($("#badgeTable"), entry.registrantId).length)
+	{
+		return false;
+	}
+	var row = render_registrant(entry);
+	var title_elem = row.first();
+	var data_elem = title_elem.next();
+	accordion_replace_item($("#badgeTable"), entry.registrantId, title_elem, data_elem);
+	return true;
+}
+
 function update_entry(entry)
 {
 	if(entry === false)
@@ -36,10 +49,7 @@ function update_entry(entry)
 		));
 		return false;
 	}
-	var row = render_registrant(entry);
-	var title_elem = row.first();
-	var data_elem = title_elem.next();
-	accordion_replace_item($("#badgeTable"), entry.registrantId, title_elem, data_elem);
+	replace_entry(entry);
 	return true;
 }
 
@@ -53,14 +63,78 @@ function update_entry_and_print(entry)
 	$.getJSON(`/print_badge?id=${entry.registrantId}&name=${printer_name}`);
 }
 
-function update_table(data)
+const PAGE_SIZE = 100;
+
+var current_criteria = "";
+var next_cursor = null;
+var search_generation = 0;
+var page_loading = false;
+
+/// Adds a page of rows to the bottom of the table. Rows already on screen are never re-rendered.
+function append_rows(data)
 {
-	$("#badgeTable").empty();
 	for(var entry of data)
 	{
-		$("#badgeTable").append(render_registrant(entry));
+		if(accordion_get_title_elem($("#badgeTable"), entry.registrantId).length)
+		{
+			continue;
+		}
+		var title_elem = render_registrant(entry).first();
+		accordion_add_item_end($("#badgeTable"), title_elem, title_elem.next());
 	}
-	accordion_make($("#badgeTable"));
+}
+
+function update_result_count(total)
+{
+	var shown = accordion_count_items($("#badgeTable"));
+	$("#resultCount").text(shown < total ? `Showing ${shown} of ${total}` : `${total} found`);
+}
+
+function query_page(criteria, after)
+{
+	var generation = search_generation;
+	page_loading = true;
+	$.getJSON(`/query?criteria=${encodeURIComponent(criteria)}&limit=${PAGE_SIZE}&after=${after === null ? "" : after}`, function(page){
+		if(generation != search_generation)
+		{
+			// A newer search started while this page was in flight.
+			return;
+		}
+		page_loading = false;
+		append_rows(page.registrants);
+		next_cursor = page.next;
+		update_result_count(page.total);
+		load_more_if_needed();
+	}).fail(function(){
+		if(generation == search_generation)
+		{
+			page_loading = false;
+		}
+	});
+}
+
+/// Fetches the next page once the bottom of the table scrolls into view.
+function load_more_if_needed()
+{
+	if(page_loading || next_cursor === null)
+	{
+		return;
+	}
+	var scroller = $("#badgeTableScroller");
+	if(scroller.scrollTop() + scroller.innerHeight() + 200 >= scroller[0].scrollHeight)
+	{
+		query_page(current_criteria, next_cursor);
+	}
+}
+
+function run_search(criteria)
+{
+	current_criteria = criteria;
+	search_generation++;
+	next_cursor = null;
+	$("#badgeTable").empty();
+	$("#badgeTableScroller").scrollTop(0);
+	query_page(criteria, null);
 }
 
 function update_search(ev)
@@ -72,16 +146,32 @@ function update_search(ev)
 	}
 	ev.preventDefault();
 	$("#updateSearch").attr("value", "Reload");
-	var new_search = $("#searchBox").val();
-	var criteria = encodeURIComponent(new_search);
-	var query = `/query?criteria=${criteria}`;
-	$.getJSON(query, update_table);
+	run_search($("#searchBox").val());
 }
 
 function clear_search(ev=null)
 {
 	$("#searchBox").val("");
-	$.getJSON("/query", update_table);
+	run_search("");
+}
+
+/// Other stations and the background sync change rows under us. Patch the ones on screen in place.
+function listen_for_changes()
+{
+	if(!window.EventSource)
+	{
+		return;
+	}
+	var events = new EventSource("/events");
+	events.addEventListener("registrants", function(ev){
+		for(var entry of JSON.parse(ev.data))
+		{
+			replace_entry(entry);
+		}
+	});
+	events.addEventListener("reload", function(ev){
+		run_search(current_criteria);
+	});
 }
 
 function make_slot_selector_name(slot)
@@ -146,7 +236,9 @@ $(document).ready(function (){
 	clear_search();
 	$("#updateSearch").click(update_search);
 	$("#clearSearch").click(clear_search);
+	$("#badgeTableScroller").scroll(load_more_if_needed);
 	$("#savePrinterSettings").click(save_printer_settings);
 	$("#deletePrinterSettings").click(delete_printer_settings);
 	$.getJSON("/printer_list", populate_printer_table);
+	listen_for_changes();
 });